@@ -1,18 +1,42 @@
 '''
 Baixa dados do sentinel no repositório cloud console do google automaticamente para os 15 dias mais recentes
-É necessário ter instalado a CLI gcloud e adicionada ao PATH do sistema, caso não tenha: https://cloud.google.com/sdk/docs/install?hl=pt-br
+Por padrão o bucket público é acessado direto pela API JSON do Cloud Storage (SENTINEL_BACKEND=http).
+Como alternativa (SENTINEL_BACKEND=gcloud, ou se a API não responder) é usada a CLI gcloud, que precisa estar
+instalada e adicionada ao PATH do sistema, caso não tenha: https://cloud.google.com/sdk/docs/install?hl=pt-br
+Para rodar contra um servidor GCS falso local, defina STORAGE_EMULATOR_HOST (ex.: http://localhost:4443).
+Com SENTINEL_BACKEND=local os dados são lidos de um espelho em disco (SENTINEL_MIRROR_DIR) com o layout <zona>/<banda>/<quadrado>/.
 URL para abertura manual: https://console.cloud.google.com/storage/browser/gcp-public-data-sentinel-2/L2/tiles/
 '''
 
 import xml.etree.ElementTree as ET
-import tempfile
 import subprocess
+import argparse
+import http.client
+import json
+import csv
+import gzip
+import io
+import queue
+import urllib.parse
+from collections import namedtuple
+from contextlib import contextmanager
 import os
 import logging
 from logging.handlers import RotatingFileHandler
 from datetime import datetime, timedelta
 import shutil
+import glob
 import re
+import time
+import random
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import numpy as np
+except ImportError: # Opcional: sem NumPy, a ProductTable guarda as colunas em listas
+    np = None
 
 # --- Configuração de Logging ---
 def setup_logging():
@@ -54,170 +78,3131 @@ codigos = [
 # URL base usada no script:
 BUCKET_BASE_URI = "gs://gcp-public-data-sentinel-2/L2/tiles"
 
+# Número de listagens 'gcloud storage ls' executadas em paralelo (uma por tile):
+MAX_WORKERS_LISTAGEM = 8
+
+# No Windows o gcloud é um .cmd e precisa do shell; no Linux/macOS a lista de argumentos é executada diretamente.
+USAR_SHELL = os.name == "nt"
+
+def build_tile_uri(codigo):
+    """Constrói a URI do diretório de um tile a partir de [zona, banda, quadrado]."""
+    return f"{BUCKET_BASE_URI}/{codigo[0]}/{codigo[1]}/{codigo[2]}/"
+
+# Pasta .SAFE encontrada na listagem: URI completa, nome da pasta e data de aquisição (YYYYMMDD ou None)
+SafeProduct = namedtuple("SafeProduct", ["uri", "nome", "data_sensor"])
+
+# Data de aquisição (sensing) no nome do produto, ex.: S2A_MSIL2A_20240105T131241_...
+SENSING_DATE_PATTERN = re.compile(r'_(\d{8})T')
+
+def get_product_name(safe_folder_uri):
+    """Retorna o nome da pasta .SAFE (ex.: S2A_MSIL2A_..._20240105T170000.SAFE) a partir da URI."""
+    return os.path.basename(safe_folder_uri.strip('/'))
+
+def get_sensing_date(nome_pasta):
+    """Retorna a data de aquisição (YYYYMMDD) contida no nome do produto, ou None."""
+    match = SENSING_DATE_PATTERN.search(nome_pasta)
+    return match.group(1) if match else None
+
+# Data e hora de aquisição no nome do produto, ex.: S2A_MSIL2A_20240105T131241_... → 20240105T131241
+SENSING_TIMESTAMP_PATTERN = re.compile(r'_(\d{8}T\d{6})_')
+
+def get_sensing_timestamp(nome_pasta):
+    match = SENSING_TIMESTAMP_PATTERN.search(nome_pasta)
+    return match.group(1) if match else None
+
+def make_safe_product(safe_folder_uri):
+    """Monta o SafeProduct de uma URI .SAFE/."""
+    nome_pasta = get_product_name(safe_folder_uri)
+    return SafeProduct(safe_folder_uri, nome_pasta, get_sensing_date(nome_pasta))
+
+# Tile MGRS no nome do produto, ex.: ..._R138_T23KNQ_... → 23KNQ
+TILE_ID_PATTERN = re.compile(r'_T(\d{2}[A-Z]{3})_')
+
+def get_tile_id(nome_pasta):
+    """Retorna o tile MGRS (ex.: 23KNQ) contido no nome do produto, ou None."""
+    match = TILE_ID_PATTERN.search(nome_pasta)
+    return match.group(1) if match else None
+
+# --- Nomes de Produtos Sentinel-2 ---
+# Nome completo de um produto: missão, nível, aquisição, baseline de processamento, órbita relativa, tile e geração,
+# ex.: S2A_MSIL2A_20240105T131241_N0510_R138_T23KNQ_20240105T170000.SAFE
+PRODUCT_NAME_PATTERN = re.compile(
+    r'^(S2[A-Z])_MSI(L[12][AC])_(\d{8}T\d{6})_N(\d{4})_R(\d{3})_T(\d{2}[A-Z]{3})_(\d{8}T\d{6})(?:\.SAFE)?$')
+
+class ProductName:
+    """Campos decodificados do nome de um produto. Usa __slots__ para que milhões deles caibam na memória."""
+    __slots__ = ("nome", "missao", "nivel", "aquisicao", "baseline", "orbita", "tile", "gerado_em")
+
+    def __init__(self, nome, missao, nivel, aquisicao, baseline, orbita, tile, gerado_em):
+        self.nome = nome
+        self.missao = missao # S2A, S2B, S2C...
+        self.nivel = nivel # L2A
+        self.aquisicao = aquisicao # YYYYMMDDTHHMMSS
+        self.baseline = baseline # N0510 → 510
+        self.orbita = orbita # R138 → 138
+        self.tile = tile # 23KNQ
+        self.gerado_em = gerado_em # YYYYMMDDTHHMMSS
+
+    @classmethod
+    def parse(cls, nome_pasta):
+        """Decodifica o nome de uma pasta .SAFE (ou sua URI). Retorna None se o nome não seguir o padrão."""
+        match = PRODUCT_NAME_PATTERN.match(nome_pasta.rstrip('/').rpartition('/')[2])
+        if not match:
+            return None
+        missao, nivel, aquisicao, baseline, orbita, tile, gerado_em = match.groups()
+        return cls(match.string, missao, nivel, aquisicao, int(baseline), int(orbita), tile, gerado_em)
+
+    @property
+    def data_sensor(self):
+        return self.aquisicao[:8]
+
+    def __repr__(self):
+        return f"ProductName({self.nome!r})"
+
+class ProductTable:
+    """
+    Produtos de uma listagem em colunas (uri, nome, missao, data, baseline, orbita), para filtrar
+    listagens inteiras de uma vez. Com NumPy as colunas são arrays e os filtros são vetorizados; sem ele,
+    são listas e o resultado é o mesmo. Nomes fora do padrão do Sentinel-2 ficam de fora da tabela, com um aviso,
+    em todos os caminhos da listagem (com ou sem cache).
+    """
+    COLUNAS = ("uri", "nome", "missao", "data", "baseline", "orbita")
+    TIPOS_NUMPY = {"uri": object, "nome": object, "missao": "U3", "data": "int32", "baseline": "int16", "orbita": "int16"}
+
+    def __init__(self, colunas, ignorados=0):
+        self.colunas = colunas
+        self.ignorados = ignorados # Nomes fora do padrão descartados ao montar a tabela
+
+    @classmethod
+    def from_uris(cls, uris):
+        """Monta a tabela a partir de URIs .SAFE/ ou de nomes de pastas."""
+        linhas = []
+        ignorados = 0
+        for uri in uris:
+            registro = ProductName.parse(uri)
+            if registro is None:
+                ignorados += 1
+                continue
+            linhas.append((uri, registro.nome, registro.missao, int(registro.data_sensor), registro.baseline,
+                           registro.orbita))
+        if ignorados:
+            logging.warning(f"⚠️ {ignorados} pasta(s) com nome fora do padrão Sentinel-2 ignorada(s).")
+        colunas = dict(zip(cls.COLUNAS, (list(valores) for valores in zip(*linhas)))) if linhas \
+            else {nome: [] for nome in cls.COLUNAS}
+        if np is not None:
+            colunas = {nome: np.array(valores, dtype=cls.TIPOS_NUMPY[nome]) for nome, valores in colunas.items()}
+        return cls(colunas, ignorados)
+
+    def __len__(self):
+        return len(self.colunas["nome"])
+
+    @property
+    def uris(self):
+        return list(self.colunas["uri"])
+
+    def safe_products(self):
+        """Gera um SafeProduct por linha da tabela."""
+        for uri, nome, data in zip(self.colunas["uri"], self.colunas["nome"], self.colunas["data"]):
+            yield SafeProduct(uri, nome, str(data))
+
+    def filter(self, datas=None, missoes=None, orbitas=None, baseline_minima=None):
+        """
+        Retorna uma nova tabela só com os produtos que atendem a todos os critérios informados: 'datas' (conjunto
+        de YYYYMMDD), 'missoes' (ex.: {"S2A"}), 'orbitas' (ex.: {138}) e 'baseline_minima' (ex.: 510 para N0510).
+        """
+        criterios = []
+        if datas is not None:
+            criterios.append(("data", "in", {int(data) for data in datas}))
+        if missoes is not None:
+            criterios.append(("missao", "in", set(missoes)))
+        if orbitas is not None:
+            criterios.append(("orbita", "in", {int(orbita) for orbita in orbitas}))
+        if baseline_minima is not None:
+            criterios.append(("baseline", ">=", int(baseline_minima)))
+
+        if np is not None:
+            mascara = np.ones(len(self), dtype=bool)
+            for coluna, operador, valor in criterios:
+                dados = self.colunas[coluna]
+                if operador == "in":
+                    mascara &= np.isin(dados, np.array(sorted(valor), dtype=dados.dtype))
+                else:
+                    mascara &= dados >= valor
+            return ProductTable({nome: dados[mascara] for nome, dados in self.colunas.items()})
+
+        comparacoes = {"in": lambda a, b: a in b, ">=": lambda a, b: a >= b}
+        indices = [i for i in range(len(self))
+                   if all(comparacoes[operador](self.colunas[coluna][i], valor) for coluna, operador, valor in criterios)]
+        return ProductTable({nome: [dados[i] for i in indices] for nome, dados in self.colunas.items()})
+
 def get_recent_dates(num_days=15):
     """Retorna um conjunto de strings de data (YYYYMMDD) dos últimos N dias."""
     today = datetime.now()
     return { (today - timedelta(days=i)).strftime('%Y%m%d') for i in range(num_days) }
 
+def get_date_range(inicio, fim):
+    """Retorna o conjunto de datas (YYYYMMDD) de 'inicio' a 'fim', inclusive."""
+    dia = datetime.strptime(inicio, '%Y%m%d')
+    ultimo = datetime.strptime(fim, '%Y%m%d')
+    datas = set()
+    while dia <= ultimo:
+        datas.add(dia.strftime('%Y%m%d'))
+        dia += timedelta(days=1)
+    return datas
+
+def parse_date(texto):
+    """Converte AAAA-MM-DD ou AAAAMMDD em YYYYMMDD (usado como 'type' do argparse)."""
+    for formato in ('%Y-%m-%d', '%Y%m%d'):
+        try:
+            return datetime.strptime(texto, formato).strftime('%Y%m%d')
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"data inválida: '{texto}' (use AAAA-MM-DD)")
+
+# --- Política de Retentativas ---
+MAX_TENTATIVAS = 4 # Tentativas por operação, contando a primeira
+ESPERA_BASE_S = 1.0 # Espera máxima antes da 2ª tentativa; dobra a cada nova tentativa
+ESPERA_MAXIMA_S = 60.0
+
+# Respostas da API que indicam falha passageira (limite de requisições, sobrecarga, timeout)
+STATUS_HTTP_RETENTAVEIS = {408, 429, 500, 502, 503, 504}
+
+# Trechos do stderr do gcloud que indicam falha passageira, e não um objeto inexistente ou sem permissão
+GCLOUD_ERRO_RETENTAVEL_PATTERN = re.compile(
+    r'\b(408|429|500|502|503|504)\b|too many requests|rate limit|backend ?error|service unavailable|'
+    r'internal error|connection (reset|aborted|refused)|timed out|timeout|temporar|try again|'
+    r'remote end closed|broken pipe|ssl',
+    re.IGNORECASE)
+
+class GcloudCommandError(Exception):
+    """Comando gcloud que terminou com código de saída diferente de zero."""
+
+    def __init__(self, command, returncode, stderr):
+        super().__init__(f"'{' '.join(command[:3])}' terminou com código {returncode}: {stderr.strip()}")
+        self.returncode = returncode
+        self.stderr = stderr
+
+# Prazos (s) dos comandos gcloud; um comando que passa do prazo é encerrado e conta como falha passageira
+TIMEOUT_GCLOUD_LISTAGEM = 300
+TIMEOUT_GCLOUD_LEITURA = 120 # 'cat' de metadados e manifestos
+TIMEOUT_GCLOUD_INDICE = 2 * 3600 # 'cat' do index.csv.gz inteiro, lido à medida que chega
+TIMEOUT_GCLOUD_DOWNLOAD = 4 * 3600 # 'rsync'/'cp' de um produto inteiro; travamentos são pegos antes pelo watchdog
+
+def run_gcloud(command, text=True, timeout=TIMEOUT_GCLOUD_LEITURA, transferencia=None):
+    """
+    Executa um comando gcloud e retorna o stdout. Levanta GcloudCommandError se ele falhar e
+    subprocess.TimeoutExpired se passar de 'timeout'. Se uma Transfer for informada, o watchdog
+    pode encerrar o processo caso ela trave.
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=text, shell=USAR_SHELL)
+    with attach_to_transfer(transferencia, process):
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+    if process.returncode != 0:
+        stderr = stderr if text else stderr.decode('utf-8', errors='ignore')
+        raise GcloudCommandError(command, process.returncode, stderr)
+    return stdout
+
+def is_retryable(erro):
+    """Classifica um erro como passageiro (vale tentar de novo) ou definitivo."""
+    if isinstance(erro, GcsHttpError):
+        return erro.status in STATUS_HTTP_RETENTAVEIS
+    if isinstance(erro, GcloudCommandError):
+        return bool(GCLOUD_ERRO_RETENTAVEL_PATTERN.search(erro.stderr))
+    # Conexão recusada/resetada, timeouts (de socket ou de prazo do gcloud) e respostas HTTP truncadas
+    return isinstance(erro, (ConnectionError, TimeoutError, subprocess.TimeoutExpired, http.client.HTTPException))
+
+class RetryPolicy:
+    """
+    Repete operações que falham com erros passageiros, com backoff exponencial e jitter completo
+    (espera sorteada entre 0 e base * 2^(tentativa-1), limitada a 'espera_maxima'), para que os
+    workers que falharam juntos não voltem todos ao mesmo tempo.
+    """
+
+    def __init__(self, max_tentativas=MAX_TENTATIVAS, espera_base=ESPERA_BASE_S, espera_maxima=ESPERA_MAXIMA_S,
+                 classificador=is_retryable):
+        self.max_tentativas = max(1, max_tentativas)
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self.classificador = classificador
+
+    def delay(self, tentativa, erro=None):
+        espera = random.uniform(0, min(self.espera_maxima, self.espera_base * 2 ** (tentativa - 1)))
+        # Um 429/503 pode dizer quanto esperar (Retry-After)
+        sugerida = getattr(erro, "retry_after", None)
+        return max(espera, min(sugerida, self.espera_maxima)) if sugerida else espera
+
+    def _wait_or_raise(self, erro, tentativa, descricao):
+        if tentativa >= self.max_tentativas or not self.classificador(erro):
+            raise erro
+        espera = self.delay(tentativa, erro)
+        logging.warning(f"🔁 {descricao} falhou ({erro}). Tentativa {tentativa + 1} de {self.max_tentativas} em {espera:.1f}s.")
+        time.sleep(espera)
+
+    def call(self, funcao, *args, descricao=None, **kwargs):
+        """Chama funcao(*args, **kwargs), repetindo enquanto o erro for passageiro."""
+        for tentativa in range(1, self.max_tentativas + 1):
+            try:
+                return funcao(*args, **kwargs)
+            except Exception as e:
+                self._wait_or_raise(e, tentativa, descricao or getattr(funcao, "__name__", "Operação"))
+
+    def iterate(self, fabrica, descricao):
+        """
+        Consome o gerador criado por fabrica(), recomeçando do início se ele falhar com um erro passageiro.
+        Na nova tentativa, os itens já entregues antes da falha são pulados pela posição, sem guardá-los na
+        memória; isso supõe que o gerador devolve sempre a mesma ordem, como o 'gcloud storage ls'. Se a listagem
+        mudar entre as tentativas, um item pode se repetir (o pipeline descarta produtos já enfileirados).
+        """
+        entregues = 0
+        for tentativa in range(1, self.max_tentativas + 1):
+            try:
+                for posicao, item in enumerate(fabrica()):
+                    if posicao >= entregues:
+                        entregues += 1
+                        yield item
+                return
+            except Exception as e:
+                self._wait_or_raise(e, tentativa, descricao)
+
+# Política usada por listagens, leituras de metadados e downloads
+RETENTATIVAS = RetryPolicy()
+
+# --- Watchdog de Transferências ---
+LIMITE_SEM_PROGRESSO_S = 180 # Transferência sem nenhum byte novo no disco por esse tempo é considerada travada
+INTERVALO_WATCHDOG_S = 10 # Intervalo entre as verificações de progresso
+
+class TransferStalledError(Exception):
+    """A transferência foi encerrada pelo watchdog por falta de progresso."""
+
+class Transfer:
+    """
+    Uma transferência vigiada pelo TransferWatchdog. 'medidor' retorna quantos bytes ela já gravou;
+    processos anexados com attach_to_transfer() são encerrados se ela for cancelada.
+    """
+
+    def __init__(self, nome, medidor):
+        self.nome = nome
+        self.medidor = medidor
+        self.ultimo_valor = None
+        self.ultimo_progresso = time.monotonic()
+        self.travada = False
+        self.erro = None # Motivo da última falha, para quem iniciou a transferência
+        self.pausas = 0 # Esperas em andamento que não contam como falta de progresso
+        self._processos = set()
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Levanta TransferStalledError se o watchdog já tiver cancelado a transferência."""
+        if self.travada:
+            raise TransferStalledError(f"Transferência de {self.nome} cancelada por falta de progresso.")
+
+    @contextmanager
+    def paused(self):
+        """Suspende o relógio de progresso enquanto o bloco roda, ex.: na espera do limite de banda."""
+        with self._lock:
+            self.pausas += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.pausas -= 1
+                self.ultimo_progresso = time.monotonic()
+
+    def cancel(self):
+        with self._lock:
+            self.travada = True
+            processos = list(self._processos)
+        for process in processos:
+            if process.poll() is None:
+                process.kill()
+
+@contextmanager
+def attach_to_transfer(transferencia, process):
+    """Registra o processo na transferência (se houver) enquanto o bloco roda."""
+    if transferencia is None:
+        yield
+        return
+    with transferencia._lock:
+        transferencia._processos.add(process)
+    try:
+        if transferencia.travada and process.poll() is None:
+            process.kill() # Cancelada entre a criação do processo e o registro
+        yield
+    finally:
+        with transferencia._lock:
+            transferencia._processos.discard(process)
+
+class TransferWatchdog:
+    """
+    Uma única thread verifica periodicamente todas as transferências em andamento, por mais que sejam,
+    e cancela as que ficaram 'limite' segundos sem progresso. Cada travamento é registrado no log e,
+    se houver um StateDatabase, na tabela eventos_transferencia.
+    """
+
+    def __init__(self, banco=None, limite=LIMITE_SEM_PROGRESSO_S, intervalo=INTERVALO_WATCHDOG_S):
+        self.banco = banco
+        self.limite = limite
+        self.intervalo = intervalo
+        self._transferencias = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        if self.banco is not None:
+            self.banco.execute(
+                """CREATE TABLE IF NOT EXISTS eventos_transferencia (
+                       produto TEXT NOT NULL,
+                       ocorrido_em TEXT NOT NULL,
+                       tipo TEXT NOT NULL,
+                       detalhe TEXT)""")
+
+    @contextmanager
+    def watch(self, nome, medidor):
+        """Vigia a transferência enquanto o bloco roda e entrega o objeto Transfer."""
+        transferencia = Transfer(nome, medidor)
+        with self._lock:
+            self._transferencias.add(transferencia)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._monitor, name="watchdog", daemon=True)
+                self._thread.start()
+        try:
+            yield transferencia
+        finally:
+            with self._lock:
+                self._transferencias.discard(transferencia)
+
+    def _monitor(self):
+        while True:
+            time.sleep(self.intervalo)
+            with self._lock:
+                transferencias = list(self._transferencias)
+            agora = time.monotonic()
+            for transferencia in transferencias:
+                if transferencia.travada or transferencia.pausas:
+                    continue
+                try:
+                    valor = transferencia.medidor()
+                except Exception:
+                    continue
+                if valor != transferencia.ultimo_valor:
+                    transferencia.ultimo_valor = valor
+                    transferencia.ultimo_progresso = agora
+                elif agora - transferencia.ultimo_progresso >= self.limite:
+                    self._stall(transferencia, agora - transferencia.ultimo_progresso)
+
+    def _stall(self, transferencia, parado):
+        detalhe = f"sem progresso há {parado:.0f}s com {format_bytes(transferencia.ultimo_valor or 0)} gravados"
+        logging.warning(f"⏱️ Transferência de {transferencia.nome} travada ({detalhe}). Encerrando.")
+        transferencia.cancel()
+        self.record(transferencia.nome, "travada", detalhe)
+
+    def record(self, nome, tipo, detalhe=None):
+        if self.banco is None:
+            return
+        self.banco.execute("INSERT INTO eventos_transferencia (produto, ocorrido_em, tipo, detalhe) VALUES (?, ?, ?, ?)",
+                           (nome, datetime.now().isoformat(timespec='seconds'), tipo, detalhe))
+
 # --- Funções de Execução de Comandos ---
 
-def get_available_safe_folders(uri_base):
-    """Lista TUDO em um diretório e filtra as pastas .SAFE/ em Python."""
-    # Comando simplificado para listar todo o conteúdo do diretório base
-    command = ["gcloud", "storage", "ls", uri_base]
-    logging.info(f"📂 Listando todo o conteúdo de: {uri_base}")
+# Extrai a URI da pasta .SAFE de uma linha do 'gcloud storage ls' (a linha pode ser a própria pasta,
+# um cabeçalho "gs://.../X.SAFE/:" ou um item dentro dela quando a URI usa curingas)
+SAFE_URI_PATTERN = re.compile(r'^(gs://\S+?\.SAFE/)')
+
+def build_date_patterns(uri_base, datas):
+    """
+    Gera uma URI com curinga por dia da janela, para que o bucket só devolva os produtos daquelas datas.
+    O curinga é ancorado no campo de aquisição: a data de geração, no fim do nome, também tem o formato _YYYYMMDDT.
+    """
+    return [f"{uri_base}*_MSIL2A_{data}T*" for data in sorted(datas)]
+
+def iter_safe_folders(linhas):
+    """
+    Consome as linhas do 'gcloud storage ls' à medida que chegam e gera um SafeProduct por pasta .SAFE/.
+    As linhas de uma mesma pasta (cabeçalho e conteúdo) vêm juntas, então basta lembrar a última pasta vista.
+    """
+    ultima_pasta = None
+    for item in linhas:
+        match = SAFE_URI_PATTERN.match(item.strip())
+        if match and match.group(1) != ultima_pasta:
+            ultima_pasta = match.group(1)
+            yield make_safe_product(ultima_pasta)
+
+def iter_available_safe_folders(uri_base, datas=None):
+    """
+    Lista as pastas .SAFE/ de um diretório como um gerador: cada pasta é entregue assim que o
+    'gcloud storage ls' a imprime, sem guardar a saída inteira na memória.
+    Se 'datas' (YYYYMMDD) for informado, a janela de datas é enviada na própria consulta
+    como um curinga por dia, em vez de listar todo o histórico do tile.
+    """
+    if datas:
+        command = ["gcloud", "storage", "ls"] + build_date_patterns(uri_base, datas)
+        logging.info(f"📂 Listando {len(datas)} dia(s) de produtos em: {uri_base}")
+    else:
+        # Comando simplificado para listar todo o conteúdo do diretório base
+        command = ["gcloud", "storage", "ls", uri_base]
+        logging.info(f"📂 Listando todo o conteúdo de: {uri_base}")
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=USAR_SHELL)
+    # O stderr é lido em paralelo para que um buffer cheio não trave o gcloud enquanto o stdout é consumido
+    stderr_partes = []
+    leitor_stderr = threading.Thread(target=lambda: stderr_partes.append(process.stderr.read()), daemon=True)
+    leitor_stderr.start()
+    # Prazo da listagem inteira: se estourar, o processo é encerrado e a leitura do stdout termina
+    estourou = threading.Event()
+
+    def encerrar():
+        estourou.set()
+        process.kill()
+
+    prazo = threading.Timer(TIMEOUT_GCLOUD_LISTAGEM, encerrar)
+    prazo.daemon = True
+    prazo.start()
+    encontradas = 0
     try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True, shell=True)
-        # Pega todas as linhas retornadas
-        all_items = result.stdout.strip().split('\n')
-        
-        # Filtra a lista para pegar apenas as pastas principais que terminam com .SAFE/
-        safe_folders = [item for item in all_items if item.endswith('.SAFE/')]
-        
-        if safe_folders:
-            logging.info(f"✔️ Encontradas {len(safe_folders)} pastas .SAFE para análise.")
-        else:
-            logging.info("➡️ Nenhuma pasta .SAFE encontrada neste diretório.")
-        return safe_folders
+        for produto in iter_safe_folders(process.stdout):
+            encontradas += 1
+            yield produto
+        process.wait()
+    finally:
+        prazo.cancel()
+        # Se o consumidor parar antes do fim da listagem, o gcloud é encerrado
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        leitor_stderr.join()
+        process.stdout.close()
+        process.stderr.close()
 
-    except subprocess.CalledProcessError as e:
-        stderr_output = e.stderr.decode('utf-8', errors='ignore')
+    if estourou.is_set():
+        raise subprocess.TimeoutExpired(command, TIMEOUT_GCLOUD_LISTAGEM)
+    stderr_output = "".join(stderr_partes)
+    # Tile vazio ou dias sem aquisição (com curingas por dia) fazem o gcloud terminar com erro
+    # ("matched no objects"), mas os dias encontrados já foram entregues.
+    if process.returncode != 0 and "matched no objects" not in stderr_output:
         # Ignora o erro comum "Bucket Brigade" que não é crítico.
-        if "Bucket Brigade" not in stderr_output:
-            logging.warning(f"⚠️ Erro ao listar {uri_base}. Pode não existir ou estar vazio. Erro: {stderr_output}")
-        else:
+        if "Bucket Brigade" in stderr_output:
             logging.info(f"➡️ Nenhuma pasta .SAFE encontrada em {uri_base}.")
-        return []
+            return
+        # Qualquer outro erro vai para quem chamou: passageiro, é repetido; definitivo, vai para a fila de falhas
+        raise GcloudCommandError(command, process.returncode, stderr_output)
+
+    if encontradas:
+        logging.info(f"✔️ Encontradas {encontradas} pastas .SAFE para análise.")
+    else:
+        logging.info("➡️ Nenhuma pasta .SAFE encontrada neste diretório.")
+
+# Itens em trânsito entre as listagens e o consumidor; limita a memória mesmo com listagens enormes
+TAMANHO_FILA_LISTAGEM = 1000
+
+# Produtos de um tile acumulados e filtrados de uma vez pela ProductTable (o lote também sai no fim da listagem)
+TAMANHO_LOTE_FILTRO = 500
+
+# Marca o fim da listagem de um tile na fila
+_FIM_LISTAGEM = object()
+
+def stream_tiles_concurrently(codigos_tiles, max_workers=MAX_WORKERS_LISTAGEM, datas=None, backend=None,
+                              tamanho_fila=TAMANHO_FILA_LISTAGEM, ao_terminar=None, datas_por_tile=None,
+                              cache_listagem=None, filtros=None):
+    """
+    Lista todos os tiles em paralelo e gera tuplas (codigo, SafeProduct) à medida que cada produto
+    é listado, em qualquer ordem entre tiles, para que a filtragem comece antes do fim das listagens.
+    Se informado, ao_terminar(codigo, erro) é chamado ao fim da listagem de cada tile (erro=None se deu certo).
+    'datas_por_tile' ({"23KNQ": datas}) substitui 'datas' nos tiles que tiverem uma janela própria.
+    Com um 'cache_listagem' (ListingCache), tiles listados recentemente não são consultados no bucket.
+    Os produtos passam em lotes pela ProductTable, que aplica as datas e os 'filtros' (argumentos de
+    ProductTable.filter, ex.: {"missoes": {"S2A"}}) a cada lote de uma vez.
+    """
+    backend = backend or GcloudBackend()
+    fila = queue.Queue(maxsize=max(1, tamanho_fila))
+    cancelado = threading.Event()
+
+    def enfileirar(item):
+        # Espera por espaço na fila, mas desiste se o consumidor já tiver parado
+        while not cancelado.is_set():
+            try:
+                fila.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def enviar(codigo, lote, datas_tile):
+        """Filtra um lote de URIs e enfileira os produtos que passaram. Retorna quantos foram descartados."""
+        if not lote:
+            return 0
+        tabela = ProductTable.from_uris(lote)
+        filtrada = tabela.filter(datas=datas_tile, **(filtros or {}))
+        for produto in filtrada.safe_products():
+            if not enfileirar((codigo, produto)):
+                break
+        return len(tabela) - len(filtrada)
 
-def download_folder(gcs_folder_uri, local_destination):
-    """Baixa uma pasta completa do GCS para um diretório local."""
+    def listar(codigo):
+        try:
+            uri = build_tile_uri(codigo)
+            datas_tile = (datas_por_tile or {}).get("".join(codigo), datas)
+            if cache_listagem is not None:
+                produtos = cache_listagem.iter_safe_folders(backend, uri, datas_tile)
+            else:
+                produtos = backend.iter_safe_folders(uri, datas_tile)
+            lote = []
+            descartados = 0
+            for produto in produtos:
+                lote.append(produto.uri)
+                if len(lote) >= TAMANHO_LOTE_FILTRO:
+                    descartados += enviar(codigo, lote, datas_tile)
+                    if cancelado.is_set():
+                        return
+                    lote = []
+            descartados += enviar(codigo, lote, datas_tile)
+            if cancelado.is_set():
+                return
+            if filtros and descartados:
+                logging.info(f"🎯 {descartados} produto(s) do código {codigo} fora dos filtros de missão/órbita/baseline.")
+            if ao_terminar is not None:
+                ao_terminar(codigo, None)
+        except Exception as e:
+            logging.error(f"🔥 Erro ao listar o código {codigo}: {e}")
+            if ao_terminar is not None:
+                ao_terminar(codigo, e)
+        finally:
+            enfileirar((codigo, _FIM_LISTAGEM))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for codigo in codigos_tiles:
+            executor.submit(listar, codigo)
+        try:
+            restantes = len(codigos_tiles)
+            while restantes:
+                codigo, produto = fila.get()
+                if produto is _FIM_LISTAGEM:
+                    restantes -= 1
+                    continue
+                yield codigo, produto
+        finally:
+            cancelado.set()
+
+def download_folder(gcs_folder_uri, local_destination, transferencia=None):
+    """
+    Sincroniza uma pasta completa do GCS com um diretório local ('gcloud storage rsync -r').
+    Arquivos que já existem completos em 'local_destination' não são baixados de novo.
+    Retorna True em caso de sucesso.
+    """
     local_destination_clean = os.path.normpath(local_destination)
-    command = ["gcloud", "storage", "cp", "-r", gcs_folder_uri, local_destination_clean]
+    os.makedirs(local_destination_clean, exist_ok=True)
+    command = ["gcloud", "storage", "rsync", "-r", gcs_folder_uri, local_destination_clean]
     logging.info(f"🚀 Começando o download com o comando: {' '.join(command)}")
     try:
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-
-        if process.returncode != 0:
-            logging.error(f"🔥 Falha no download da pasta '{gcs_folder_uri}'.")
-            logging.error(f"➡️ Erro retornado pelo gcloud: {stderr.decode('utf-8', errors='ignore')}")
-        else:
-            logging.info(f"✔️ Download de '{gcs_folder_uri}' para '{local_destination_clean}' concluído com sucesso.")
+        # Se uma tentativa falhar no meio, a seguinte só transfere o que o rsync ainda não copiou
+        RETENTATIVAS.call(run_gcloud, command, timeout=TIMEOUT_GCLOUD_DOWNLOAD, transferencia=transferencia,
+                          descricao=f"Download de '{gcs_folder_uri}'")
+        return True
+    except GcloudCommandError as e:
+        logging.error(f"🔥 Falha no download da pasta '{gcs_folder_uri}'.")
+        logging.error(f"➡️ Erro retornado pelo gcloud: {e.stderr}")
+        return False
     except Exception as e:
         logging.error(f"🔥 Um erro inesperado ocorreu durante o download: {e}")
+        return False
+
+# Linha de objeto do 'gcloud storage ls -l': tamanho, data de criação e URI
+LONG_LISTING_PATTERN = re.compile(r'^\s*(\d+)\s+\S+\s+(gs://\S+)$')
 
-def get_cloud_cover(safe_folder_uri):
+def list_objects_gcloud(uri_prefixo):
+    """Lista recursivamente os objetos sob um prefixo com 'gcloud storage ls -r -l'. Retorna [(nome_do_objeto, tamanho_em_bytes)]."""
+    command = ["gcloud", "storage", "ls", "-r", "-l", f"{uri_prefixo}**"]
+    objetos = []
+    for linha in run_gcloud(command, timeout=TIMEOUT_GCLOUD_LISTAGEM).splitlines():
+        match = LONG_LISTING_PATTERN.match(linha)
+        if match:
+            objetos.append((split_gcs_uri(match.group(2))[1], int(match.group(1))))
+    return objetos
+
+def download_selected_objects(gcs_folder_uri, nomes_objetos, destino, transferencia=None):
     """
-    Baixa o arquivo de metadados de uma pasta .SAFE, extrai a porcentagem
-    de cobertura de nuvens e apaga o arquivo de metadados local. Tenta múltiplas
-    tags de nuvem para maior compatibilidade.
-    Retorna a porcentagem de nuvens como float ou None se falhar.
+    Baixa apenas os objetos indicados de uma pasta .SAFE para 'destino', preservando a estrutura de subpastas.
+    Faz um 'gcloud storage cp' por subpasta de destino. Retorna True em caso de sucesso.
     """
-    metadata_filename = "MTD_MSIL2A.xml"
-    metadata_file_uri = f"{safe_folder_uri}{metadata_filename}"
-    temp_xml_path = os.path.join(tempfile.gettempdir(), metadata_filename)
+    bucket, prefixo = split_gcs_uri(gcs_folder_uri)
+    por_pasta = {}
+    for nome_objeto in nomes_objetos:
+        relativo = nome_objeto[len(prefixo):]
+        por_pasta.setdefault(os.path.dirname(relativo), []).append(f"gs://{bucket}/{nome_objeto}")
 
-    # Lista de tags para procurar, em ordem de preferência.
-    # A primeira que for encontrada será usada.
-    cloud_tags_to_try = [
-        'Cloud_Coverage_Assessment',
-        'CLOUDY_PIXEL_OVER_LAND_PERCENTAGE',
-        'CLOUDY_PIXEL_PERCENTAGE']
+    for pasta_relativa, uris in por_pasta.items():
+        pasta_local = os.path.join(destino, *pasta_relativa.split("/")) if pasta_relativa else destino
+        os.makedirs(pasta_local, exist_ok=True)
+        command = ["gcloud", "storage", "cp"] + uris + [pasta_local]
+        try:
+            RETENTATIVAS.call(run_gcloud, command, timeout=TIMEOUT_GCLOUD_DOWNLOAD, transferencia=transferencia,
+                              descricao=f"Download de '{gcs_folder_uri}{pasta_relativa}'")
+        except GcloudCommandError as e:
+            logging.error(f"🔥 Falha no download dos arquivos selecionados de '{gcs_folder_uri}'.")
+            logging.error(f"➡️ Erro retornado pelo gcloud: {e.stderr}")
+            return False
+    return True
 
-    command = ["gcloud", "storage", "cp", metadata_file_uri, temp_xml_path]
-    logging.info(f"🔎 Verificando cobertura de nuvens em: {metadata_file_uri}")
+# Lista de tags para procurar, em ordem de preferência.
+# A primeira que for encontrada será usada.
+CLOUD_TAGS_TO_TRY = [
+    'Cloud_Coverage_Assessment',
+    'CLOUDY_PIXEL_OVER_LAND_PERCENTAGE',
+    'CLOUDY_PIXEL_PERCENTAGE']
+
+def parse_cloud_cover(root):
+    """Procura as tags de nuvem no XML de metadados. Retorna (porcentagem, tag) ou (None, None)."""
+    # Itera sobre a lista de tags possíveis
+    for tag_name in CLOUD_TAGS_TO_TRY:
+        # A sintaxe './/' busca a tag em qualquer lugar do documento XML
+        cloud_cover_element = root.find(f'.//{tag_name}')
 
+        if cloud_cover_element is not None:
+            return float(cloud_cover_element.text), tag_name  # Retorna o valor da primeira tag encontrada
+    return None, None
+
+# Nome do arquivo de metadados do produto L2A, na raiz da pasta .SAFE
+METADATA_FILENAME = "MTD_MSIL2A.xml"
+
+def cat_metadata_file(safe_folder_uri):
+    """
+    Lê o arquivo de metadados de uma pasta .SAFE direto para a memória ('gcloud storage cat'),
+    sem passar por arquivo temporário (chamadas concorrentes não disputam o mesmo caminho).
+    Retorna o conteúdo em bytes ou None se falhar.
+    """
+    metadata_file_uri = f"{safe_folder_uri}{METADATA_FILENAME}"
+    command = ["gcloud", "storage", "cat", metadata_file_uri]
+    logging.info(f"🔎 Verificando cobertura de nuvens em: {metadata_file_uri}")
     try:
-        # Executa o download do arquivo de metadados
-        subprocess.run(command, check=True, capture_output=True, text=True, shell=True)
-        
-        tree = ET.parse(temp_xml_path)
-        root = tree.getroot()
-        
-        # Itera sobre a lista de tags possíveis
-        for tag_name in cloud_tags_to_try:
-            # A sintaxe './/' busca a tag em qualquer lugar do documento XML
-            cloud_cover_element = root.find(f'.//{tag_name}')
-            
-            if cloud_cover_element is not None:
-                cloud_cover = float(cloud_cover_element.text)
-                logging.info(f"☁️ Cobertura de nuvens encontrada usando a tag '{tag_name}': {cloud_cover:.2f}%")
-                return cloud_cover  # Retorna o valor da primeira tag encontrada
-
-        # Se o loop terminar sem encontrar nenhuma das tags
-        logging.warning(f"⚠️ Nenhuma das tags de nuvem {cloud_tags_to_try} foi encontrada em {metadata_filename}.")
+        # Lê o arquivo de metadados pelo stdout, em bytes, para o parser respeitar o encoding declarado no XML
+        return RETENTATIVAS.call(run_gcloud, command, text=False, descricao=f"Leitura de '{metadata_file_uri}'")
+    except GcloudCommandError as e:
+        logging.error(f"🔥 Falha ao baixar o arquivo de metadados '{metadata_file_uri}'. Erro: {e.stderr}")
+        return None
+    except subprocess.TimeoutExpired as e:
+        logging.error(f"🔥 Falha ao baixar o arquivo de metadados '{metadata_file_uri}'. Erro: {e}")
         return None
 
-    except subprocess.CalledProcessError as e:
-        stderr_output = e.stderr.decode('utf-8', errors='ignore')
-        logging.error(f"🔥 Falha ao baixar o arquivo de metadados '{metadata_file_uri}'. Erro: {stderr_output}")
+# Quantidade de MTD_MSIL2A.xml lidos por invocação do gcloud. Limitado para que a linha de comando
+# caiba no limite do Windows (~8 mil caracteres) com URIs de ~140 caracteres.
+TAMANHO_LOTE_METADADOS = 40
+
+# Cada arquivo de metadados começa com a sua própria declaração XML
+XML_DECLARATION_PATTERN = re.compile(rb'(?=<\?xml )')
+
+def split_xml_documents(data):
+    """Separa a saída concatenada do 'gcloud storage cat' em um documento XML por arquivo."""
+    return [doc for doc in XML_DECLARATION_PATTERN.split(data) if doc.strip()]
+
+def _strip_safe_suffix(nome_produto):
+    return nome_produto[:-len(".SAFE")] if nome_produto.endswith(".SAFE") else nome_produto
+
+def cat_metadata_files(safe_folder_uris, tamanho_lote=TAMANHO_LOTE_METADADOS):
+    """
+    Lê os MTD_MSIL2A.xml de vários produtos em lotes, com um único 'gcloud storage cat' por lote.
+    Cada documento é associado ao seu produto pela tag PRODUCT_URI; produtos que ficarem sem
+    resposta no lote são lidos individualmente com cat_metadata_file().
+    Retorna um dicionário {uri_da_pasta: bytes} com os produtos que puderam ser lidos.
+    """
+    documentos = {}
+    tamanho_lote = max(1, tamanho_lote)
+    for inicio in range(0, len(safe_folder_uris), tamanho_lote):
+        lote = safe_folder_uris[inicio:inicio + tamanho_lote]
+        if len(lote) == 1:
+            break  # Um único produto não precisa de associação por PRODUCT_URI
+        uris_por_produto = {_strip_safe_suffix(get_product_name(uri)): uri for uri in lote}
+        command = ["gcloud", "storage", "cat"] + [f"{uri}{METADATA_FILENAME}" for uri in lote]
+        logging.info(f"🔎 Verificando cobertura de nuvens de {len(lote)} produto(s) em lote.")
+        try:
+            stdout_output = subprocess.run(command, check=True, capture_output=True, shell=USAR_SHELL,
+                                           timeout=TIMEOUT_GCLOUD_LEITURA * len(lote)).stdout
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            # Arquivos ausentes não impedem a leitura dos demais; eles ficam para a leitura individual
+            stdout_output = e.stdout or b""
+            logging.warning(f"⚠️ Leitura em lote incompleta. Erro: {(e.stderr or b'').decode('utf-8', errors='ignore') or e}")
+
+        for documento in split_xml_documents(stdout_output):
+            try:
+                product_uri_element = ET.fromstring(documento).find('.//PRODUCT_URI')
+            except ET.ParseError:
+                continue
+            if product_uri_element is None or not product_uri_element.text:
+                continue
+            safe_folder_uri = uris_por_produto.get(_strip_safe_suffix(product_uri_element.text.strip()))
+            if safe_folder_uri is not None:
+                documentos.setdefault(safe_folder_uri, documento)
+
+    # O que não voltou no lote é lido um a um, com o tratamento de erros usual
+    for safe_folder_uri in safe_folder_uris:
+        if safe_folder_uri not in documentos:
+            documento = cat_metadata_file(safe_folder_uri)
+            if documento is not None:
+                documentos[safe_folder_uri] = documento
+    return documentos
+
+def get_cloud_cover_batch(safe_folder_uris, cache=None, backend=None):
+    """
+    Obtém a cobertura de nuvens de vários produtos. Produtos já avaliados são respondidos pelo
+    MetadataCache (se informado); os demais têm o MTD_MSIL2A.xml lido pelo backend (gcloud por padrão)
+    e o resultado gravado no cache. Tenta múltiplas tags de nuvem para maior compatibilidade.
+    Retorna um dicionário {uri_da_pasta: porcentagem ou None}.
+    """
+    backend = backend or GcloudBackend()
+    resultados = {}
+    pendentes = []
+    for safe_folder_uri in safe_folder_uris:
+        cached = cache.get(get_product_name(safe_folder_uri)) if cache is not None else None
+        if cached is not None:
+            resultados[safe_folder_uri] = cached[0]
+        else:
+            pendentes.append(safe_folder_uri)
+    if resultados:
+        logging.info(f"🗃️ {len(resultados)} produto(s) com cobertura de nuvens já conhecida no cache.")
+
+    documentos = backend.read_metadata(pendentes) if pendentes else {}
+    for safe_folder_uri in pendentes:
+        resultados[safe_folder_uri] = None
+        nome_produto = get_product_name(safe_folder_uri)
+        documento = documentos.get(safe_folder_uri)
+        if documento is None:
+            continue
+        try:
+            root = ET.fromstring(documento)
+        except ET.ParseError:
+            logging.error(f"🔥 Falha ao analisar o arquivo XML: {safe_folder_uri}{METADATA_FILENAME}")
+            continue
+
+        cloud_cover, tag_name = parse_cloud_cover(root)
+        if cloud_cover is None:
+            logging.warning(f"⚠️ Nenhuma das tags de nuvem {CLOUD_TAGS_TO_TRY} foi encontrada em {nome_produto}.")
+            continue
+        logging.info(f"☁️ {nome_produto}: cobertura de nuvens de {cloud_cover:.2f}% (tag '{tag_name}')")
+        resultados[safe_folder_uri] = cloud_cover
+        if cache is not None:
+            cache.put(nome_produto, get_sensing_date(nome_produto), cloud_cover, tag_name)
+    return resultados
+
+# --- Controle de Banda e Vazão ---
+# Limite global de bytes/s somando todos os downloads (0 = sem limite). Só é aplicado durante a transferência
+# nos backends http e local; o gcloud não aceita limite de banda (veja GcloudBackend.download_objects)
+LIMITE_BANDA_BYTES_S = 0
+
+class BandwidthLimiter:
+    """
+    Balde de tokens compartilhado por todas as transferências. Cada bloco gravado desconta seus bytes
+    e, se o saldo ficar negativo, a thread dorme o tempo necessário para a taxa voltar ao limite.
+    """
+
+    def __init__(self, bytes_por_segundo=LIMITE_BANDA_BYTES_S):
+        self.taxa = bytes_por_segundo
+        self.capacidade = max(bytes_por_segundo, TAMANHO_BLOCO_DOWNLOAD)
+        self.saldo = self.capacidade
+        self.ultima_atualizacao = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, quantidade):
+        if self.taxa <= 0:
+            return
+        with self.lock:
+            agora = time.monotonic()
+            self.saldo = min(self.capacidade, self.saldo + (agora - self.ultima_atualizacao) * self.taxa)
+            self.ultima_atualizacao = agora
+            self.saldo -= quantidade
+            espera = -self.saldo / self.taxa if self.saldo < 0 else 0
+        if espera > 0:
+            time.sleep(espera)
+
+def copy_stream(origem, destino, limitador=None, tamanho_bloco=None, hasher=None):
+    """
+    Copia um stream para outro em blocos, respeitando o limite de banda. Se 'hasher' (hashlib) for
+    informado, cada bloco também é somado ao checksum enquanto é gravado.
+    Retorna o número de bytes copiados.
+    """
+    tamanho_bloco = tamanho_bloco or TAMANHO_BLOCO_DOWNLOAD
+    total = 0
+    while True:
+        bloco = origem.read(tamanho_bloco)
+        if not bloco:
+            return total
+        if limitador is not None:
+            limitador.consume(len(bloco))
+        destino.write(bloco)
+        if hasher is not None:
+            hasher.update(bloco)
+        total += len(bloco)
+
+def get_dir_size(caminho):
+    """Soma o tamanho, em bytes, de todos os arquivos sob um diretório."""
+    total = 0
+    for pasta, _, arquivos in os.walk(caminho):
+        for nome_arquivo in arquivos:
+            try:
+                total += os.path.getsize(os.path.join(pasta, nome_arquivo))
+            except OSError:
+                pass
+    return total
+
+def format_bytes(quantidade):
+    """Formata um número de bytes em unidades legíveis (ex.: 1.23 GB)."""
+    for unidade in ("B", "KB", "MB", "GB"):
+        if abs(quantidade) < 1024:
+            return f"{quantidade:.2f} {unidade}"
+        quantidade /= 1024
+    return f"{quantidade:.2f} TB"
+
+class TransferStats:
+    """Registra a vazão de cada produto baixado e calcula a vazão agregada da execução."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.produtos = 0
+        self.inicio = None
+        self.fim = None
+
+    def start(self):
+        """Marca o início de uma transferência; retorna o instante para o cálculo da vazão individual."""
+        agora = time.monotonic()
+        with self.lock:
+            if self.inicio is None:
+                self.inicio = agora
+        return agora
+
+    def finish(self, nome_produto, quantidade_bytes, inicio):
+        agora = time.monotonic()
+        duracao = max(agora - inicio, 1e-6)
+        with self.lock:
+            self.total_bytes += quantidade_bytes
+            self.produtos += 1
+            self.fim = agora
+        logging.info(f"📈 {nome_produto}: {format_bytes(quantidade_bytes)} em {duracao:.1f}s ({format_bytes(quantidade_bytes / duracao)}/s)")
+
+    def aggregate_rate(self):
+        """Vazão agregada em bytes/s, do início da primeira transferência ao fim da última."""
+        if self.inicio is None or self.fim is None:
+            return 0.0
+        return self.total_bytes / max(self.fim - self.inicio, 1e-6)
+
+    def log_summary(self):
+        if not self.produtos:
+            return
+        logging.info(f"📈 Vazão agregada: {self.produtos} produto(s), {format_bytes(self.total_bytes)} "
+                     f"em {self.fim - self.inicio:.1f}s ({format_bytes(self.aggregate_rate())}/s)")
+
+# --- Seleção de Bandas ---
+# Bandas a baixar por resolução, quando --bands não é informado. Vazio = pasta .SAFE completa.
+# Ex.: {"R10m": ["B02", "B03", "B04", "B08"], "R20m": ["SCL"]}
+BANDAS_SELECIONADAS = {}
+
+# Imagem de banda dentro da pasta .SAFE: GRANULE/<granulo>/IMG_DATA/R10m/T23KNQ_20240105T131241_B02_10m.jp2
+BAND_FILE_PATTERN = re.compile(r'^GRANULE/[^/]+/IMG_DATA/(R\d+m)/[^/]+_([A-Z0-9]+)_\d+m\.jp2$')
+
+# Metadados do grânulo, mantidos em downloads seletivos junto dos arquivos da raiz da pasta .SAFE
+GRANULE_METADATA_PATTERN = re.compile(r'^GRANULE/[^/]+/MTD_TL\.xml$')
+
+def parse_bands(texto):
+    """
+    Converte a especificação do --bands (resoluções separadas por ';', cada uma com suas bandas,
+    ex.: R10m:B02,B03,B04,B08;R20m:SCL) no formato de BANDAS_SELECIONADAS. Usado como 'type' do argparse.
+    """
+    bandas = {}
+    for grupo in (grupo.strip() for grupo in texto.split(";")):
+        if not grupo:
+            continue
+        resolucao, _, lista = grupo.partition(":")
+        nomes = [banda.strip().upper() for banda in lista.split(",") if banda.strip()]
+        if not re.fullmatch(r'R\d+m', resolucao.strip()) or not nomes:
+            raise argparse.ArgumentTypeError(f"grupo de bandas inválido: '{grupo}' (use, ex.: R10m:B02,B03;R20m:SCL)")
+        bandas.setdefault(resolucao.strip(), []).extend(nomes)
+    if not bandas:
+        raise argparse.ArgumentTypeError("nenhuma banda informada")
+    return bandas
+
+def select_band_objects(objetos, prefixo, bandas):
+    """
+    Filtra a listagem de uma pasta .SAFE ([(nome_do_objeto, tamanho)]) para as bandas/resoluções pedidas,
+    mais os metadados (arquivos da raiz e MTD_TL.xml), para que o produto continue legível.
+    """
+    selecionados = []
+    for nome_objeto, tamanho in objetos:
+        relativo = nome_objeto[len(prefixo):]
+        if "/" not in relativo or GRANULE_METADATA_PATTERN.match(relativo):
+            selecionados.append((nome_objeto, tamanho))
+            continue
+        match = BAND_FILE_PATTERN.match(relativo)
+        if match and match.group(2) in bandas.get(match.group(1), ()):
+            selecionados.append((nome_objeto, tamanho))
+    return selecionados
+
+# --- Staging de Downloads ---
+SUFIXO_STAGING = ".partial" # Pasta onde um produto é montado até estar completo: <nome>.SAFE.partial
+SUFIXO_ARQUIVO_PARCIAL = ".part" # Arquivo ainda sendo gravado dentro do staging
+
+def is_folder_marker(relativo):
+    """Indica se o objeto é só um marcador de pasta, como os que alguns clientes criam no bucket."""
+    return not relativo or relativo.endswith("/") or relativo.endswith("_$folder$")
+
+def object_local_path(destino, prefixo, nome_objeto):
+    """Caminho local de um objeto da pasta .SAFE (cujo nome começa com 'prefixo') dentro de 'destino'."""
+    return os.path.join(destino, *nome_objeto[len(prefixo):].split("/"))
+
+def has_expected_size(caminho, tamanho):
+    try:
+        return os.path.getsize(caminho) == tamanho
+    except OSError:
+        return False
+
+def remove_unexpected_files(pasta, caminhos_esperados):
+    """Apaga do staging o que não pertence ao produto (arquivos .part e temporários de transferências interrompidas)."""
+    esperados = {os.path.normpath(caminho) for caminho in caminhos_esperados}
+    for raiz, _, arquivos in os.walk(pasta):
+        for nome_arquivo in arquivos:
+            caminho = os.path.normpath(os.path.join(raiz, nome_arquivo))
+            if caminho not in esperados:
+                os.remove(caminho)
+
+# --- Manifesto e Verificação de Integridade ---
+MANIFEST_FILENAME = "manifest.safe"
+MAX_ARQUIVOS_PARALELOS = 4 # Arquivos de um mesmo produto baixados ao mesmo tempo
+
+# Nome do checksum no manifest.safe → algoritmo do hashlib
+ALGORITMOS_CHECKSUM = {"MD5": "md5", "SHA256": "sha256", "SHA-256": "sha256", "SHA3-256": "sha3_256"}
+
+# Entrada do manifest.safe para um arquivo do produto
+ManifestEntry = namedtuple("ManifestEntry", ["tamanho", "algoritmo", "checksum"])
+
+class ChecksumError(Exception):
+    """O arquivo baixado não confere com o checksum do manifest.safe."""
+
+def _local_name(tag):
+    # Remove o namespace ("{urn:...}dataObject" → "dataObject"), que varia entre versões do manifesto
+    return tag.rsplit("}", 1)[-1]
+
+def parse_manifest(documento):
+    """
+    Lê o manifest.safe de um produto e retorna {caminho_relativo: ManifestEntry} para cada
+    dataObject com checksum de algoritmo conhecido.
+    """
+    entradas = {}
+    for elemento in ET.fromstring(documento).iter():
+        if _local_name(elemento.tag) != "byteStream":
+            continue
+        localizacao = checksum = None
+        for filho in elemento:
+            if _local_name(filho.tag) == "fileLocation":
+                localizacao = filho.get("href")
+            elif _local_name(filho.tag) == "checksum":
+                checksum = filho
+        if not localizacao or checksum is None or not checksum.text:
+            continue
+        algoritmo = ALGORITMOS_CHECKSUM.get((checksum.get("checksumName") or "").upper())
+        if algoritmo is None:
+            continue
+        relativo = localizacao[2:] if localizacao.startswith("./") else localizacao
+        tamanho = int(elemento.get("size")) if elemento.get("size") else None
+        entradas[relativo] = ManifestEntry(tamanho, algoritmo, checksum.text.strip().lower())
+    return entradas
+
+def write_verified(origem, caminho_local, limitador=None, entrada_manifesto=None):
+    """
+    Grava um stream em <arquivo>.part, calculando o checksum do manifesto durante a gravação, e
+    renomeia para o nome final só se o checksum conferir. Não há segunda leitura do arquivo.
+    """
+    os.makedirs(os.path.dirname(caminho_local), exist_ok=True)
+    caminho_parcial = caminho_local + SUFIXO_ARQUIVO_PARCIAL
+    hasher = hashlib.new(entrada_manifesto.algoritmo) if entrada_manifesto is not None else None
+    with open(caminho_parcial, "wb") as arquivo:
+        copy_stream(origem, arquivo, limitador, hasher=hasher)
+    if hasher is not None and hasher.hexdigest() != entrada_manifesto.checksum:
+        os.remove(caminho_parcial)
+        raise ChecksumError(f"Checksum {entrada_manifesto.algoritmo} de '{caminho_local}' não confere com o {MANIFEST_FILENAME}.")
+    os.replace(caminho_parcial, caminho_local)
+
+# --- Backends de Armazenamento ---
+class StorageBackend:
+    """
+    Operações sobre o bucket usadas pelo script. Todas recebem URIs gs://, independentemente
+    de como cada backend chega aos dados. As listagens (iter_safe_folders e list_objects) já repetem as
+    falhas passageiras internamente, no ponto mais barato para cada backend; quem chama não deve repeti-las.
+    """
+    nome = None
+    verifica_manifesto = True # False quando a verificação fica a cargo da própria ferramenta de transferência
+
+    def iter_safe_folders(self, uri_base, datas=None):
+        """Gera um SafeProduct por pasta .SAFE/ do tile à medida que a listagem chega, restrito a 'datas' (YYYYMMDD) quando informado."""
+        raise NotImplementedError
+
+    def read_metadata(self, safe_folder_uris):
+        """Retorna {uri_da_pasta: bytes do MTD_MSIL2A.xml} para os produtos que puderam ser lidos."""
+        raise NotImplementedError
+
+    def list_objects(self, uri_prefixo):
+        """Lista recursivamente os objetos sob um prefixo. Retorna [(nome_do_objeto, tamanho_em_bytes)]."""
+        raise NotImplementedError
+
+    def read_object(self, uri):
+        """Lê um objeto inteiro para a memória."""
+        raise NotImplementedError
+
+    def download_object(self, uri, caminho_local, limitador=None, entrada_manifesto=None):
+        """Baixa um único objeto com write_verified(), verificando o checksum do manifesto (se houver) durante a gravação."""
+        raise NotImplementedError
+
+    @contextmanager
+    def open_object(self, uri):
+        """Abre um objeto para leitura sequencial em bytes. Por padrão, lê o objeto inteiro para a memória."""
+        yield io.BytesIO(self.read_object(uri))
+
+    def object_generation(self, uri):
+        """Identificador da versão atual do objeto, ou None se o backend não souber informá-lo."""
         return None
-    except ET.ParseError:
-        logging.error(f"🔥 Falha ao analisar o arquivo XML: {temp_xml_path}")
+
+    def listing_generation(self, uri_base):
+        """
+        Identificador barato do estado da listagem de um tile, que muda quando pastas são criadas ou removidas,
+        ou None se o backend não tiver como informá-lo sem listar.
+        """
         return None
-    finally:
-        # Garante que o arquivo temporário seja sempre removido
-        if os.path.exists(temp_xml_path):
-            os.remove(temp_xml_path)
 
-# --- Script Principal ---
-def main():
-    if not check_gcloud_availability(): # Verifica a instalação da API
-        return
+    def download_objects(self, gcs_folder_uri, objetos, destino, limitador=None, pasta_completa=False, manifesto=None,
+                         transferencia=None):
+        """
+        Baixa os objetos [(nome_do_objeto, tamanho)] de uma pasta .SAFE para 'destino', preservando as subpastas
+        e consumindo os bytes transferidos do BandwidthLimiter (se informado). Os arquivos são transferidos em
+        paralelo (MAX_ARQUIVOS_PARALELOS), do maior para o menor, e cada um é conferido com o 'manifesto'
+        ({caminho_relativo: ManifestEntry}). 'pasta_completa' indica que 'objetos' é a pasta inteira.
+        Se a 'transferencia' for cancelada pelo watchdog, os arquivos que ainda não começaram não são baixados;
+        os que estão em andamento terminam ou falham pelo TIMEOUT_HTTP.
+        Retorna True em caso de sucesso; erros de transferência ou de checksum são propagados.
+        """
+        bucket, prefixo = split_gcs_uri(gcs_folder_uri)
+        manifesto = manifesto or {}
 
-    datas_recentes = get_recent_dates(15) # Usa a função para obter as datas recentes para contruir a query
-    logging.info(f"🔎 Procurando por dados dos últimos 15 dias (de {min(datas_recentes)} a {max(datas_recentes)})")
+        def baixar(objeto):
+            nome_objeto, _ = objeto
+            if transferencia is not None:
+                transferencia.check()
+            RETENTATIVAS.call(self.download_object, f"gs://{bucket}/{nome_objeto}",
+                              object_local_path(destino, prefixo, nome_objeto), limitador,
+                              manifesto.get(nome_objeto[len(prefixo):]), descricao=f"Download de '{nome_objeto}'")
 
-    for codigo in codigos: # Loop para percorrer todas as pastas de interesse
-        # Constrói a URL usando f string:
-        uri_base_por_codigo = f"{BUCKET_BASE_URI}/{codigo[0]}/{codigo[1]}/{codigo[2]}/"
-        logging.info(f"\n{'='*20}\n⚙️  Processando código: {codigo} \n{'='*20}")
+        # Os maiores primeiro, para que o arquivo mais demorado não comece por último
+        ordenados = sorted(objetos, key=lambda objeto: objeto[1], reverse=True)
+        with ThreadPoolExecutor(max_workers=MAX_ARQUIVOS_PARALELOS) as executor:
+            for _ in executor.map(baixar, ordenados):
+                pass
+        return True
 
-        # Obtém uma lista das pastas disponiveis
-        pastas_disponiveis = get_available_safe_folders(uri_base_por_codigo)
+    def _checksum_status(self, manifesto, prefixo, baixados):
+        """Resume como os arquivos baixados nesta execução foram verificados, para o inventário."""
+        if not baixados:
+            return STATUS_VERIFICADO # Tudo já estava no staging, gravado e verificado em uma execução anterior
+        if not self.verifica_manifesto:
+            return STATUS_HASH_BUCKET
+        if not manifesto:
+            return STATUS_SEM_MANIFESTO
+        # O manifest.safe não descreve a si mesmo e fica fora da conta. Qualquer outro arquivo ausente do
+        # manifesto só teve o tamanho conferido, e basta um deles para o produto ficar como parcial.
+        relativos = [nome_objeto[len(prefixo):] for nome_objeto, _ in baixados]
+        if all(relativo in manifesto for relativo in relativos if relativo != MANIFEST_FILENAME):
+            return STATUS_VERIFICADO
+        return STATUS_PARCIAL
 
-        if not pastas_disponiveis: # Se não tiver pastas disponiveis ele pula para a próxima execução do loop
-            continue
+    def load_manifest(self, gcs_folder_uri):
+        """Lê o manifest.safe do produto. Retorna {} (download sem verificação de checksum) se não for possível."""
+        try:
+            uri = f"{gcs_folder_uri}{MANIFEST_FILENAME}"
+            return parse_manifest(RETENTATIVAS.call(self.read_object, uri, descricao=f"Leitura de '{uri}'"))
+        except Exception as e:
+            logging.warning(f"⚠️ Não foi possível ler o {MANIFEST_FILENAME} de '{gcs_folder_uri}'; checksums não serão verificados. Erro: {e}")
+            return {}
+
+    def select_objects(self, gcs_folder_uri, bandas=None):
+        """Lista os arquivos a baixar do produto, como (nome do objeto, tamanho), já filtrados pelas bandas."""
+        _, prefixo = split_gcs_uri(gcs_folder_uri)
+        objetos = [(nome_objeto, tamanho) for nome_objeto, tamanho in self.list_objects(gcs_folder_uri)
+                   if not is_folder_marker(nome_objeto[len(prefixo):])]
+        if bandas:
+            objetos = select_band_objects(objetos, prefixo, bandas)
+        return objetos
+
+    def plan_download(self, gcs_folder_uri, local_destination, bandas=None):
+        """Lista o produto e estima quantos bytes ainda faltam no disco, descontando o que já está no staging."""
+        objetos = self.select_objects(gcs_folder_uri, bandas)
+        _, prefixo = split_gcs_uri(gcs_folder_uri)
+        staging = os.path.join(os.path.normpath(local_destination), get_product_name(gcs_folder_uri)) + SUFIXO_STAGING
+        if os.path.isdir(staging):
+            pendentes = sum(tamanho for nome_objeto, tamanho in objetos
+                            if not has_expected_size(object_local_path(staging, prefixo, nome_objeto), tamanho))
+        else:
+            pendentes = sum(tamanho for _, tamanho in objetos)
+        return DownloadPlan(gcs_folder_uri, objetos, sum(tamanho for _, tamanho in objetos), pendentes)
+
+    def download_folder(self, gcs_folder_uri, local_destination, limitador=None, bandas=None, inventario=None, plano=None,
+                        transferencia=None):
+        """
+        Baixa a pasta .SAFE para dentro de 'local_destination' passando por um diretório de staging
+        (<nome>.SAFE.partial). Arquivos que já estão completos no staging, de uma execução interrompida,
+        não são baixados de novo, e a pasta final só aparece, com um rename atômico, depois que todos os
+        arquivos conferem com a listagem. Cada arquivo é verificado contra o checksum do manifest.safe
+        enquanto é gravado. Com 'bandas' ({resolução: [bandas]}), baixa só essas imagens e
+        os metadados. Se um Inventory for informado, o produto é registrado na mesma transação do rename.
+        Um DownloadPlan de plan_download() evita listar o produto de novo, e uma Transfer do TransferWatchdog
+        permite que uma transferência travada seja encerrada. Retorna True em caso de sucesso.
+        """
+        nome_pasta = get_product_name(gcs_folder_uri)
+        destino_final = os.path.join(os.path.normpath(local_destination), nome_pasta)
+        staging = destino_final + SUFIXO_STAGING
+        _, prefixo = split_gcs_uri(gcs_folder_uri)
+        try:
+            objetos = plano.objetos if plano is not None else self.select_objects(gcs_folder_uri, bandas)
+            if not objetos:
+                raise RuntimeError("nenhum arquivo a baixar")
+
+            pendentes = [(nome_objeto, tamanho) for nome_objeto, tamanho in objetos
+                         if not has_expected_size(object_local_path(staging, prefixo, nome_objeto), tamanho)]
+            if len(pendentes) < len(objetos):
+                logging.info(f"♻️ Retomando {nome_pasta}: {len(objetos) - len(pendentes)} de {len(objetos)} arquivo(s) já estavam completos.")
+            logging.info(f"🚀 Começando o download de {len(pendentes)} arquivo(s) de '{gcs_folder_uri}' ({self.nome})")
+            pasta_completa = not bandas and len(pendentes) == len(objetos)
+            manifesto = self.load_manifest(gcs_folder_uri) if pendentes else {}
+            if pendentes and not self.download_objects(gcs_folder_uri, pendentes, staging, limitador, pasta_completa,
+                                                       manifesto, transferencia):
+                raise RuntimeError(f"a transferência pelo {self.nome} falhou")
+
+            # Só promove a pasta quando todos os arquivos estão presentes e com o tamanho esperado
+            incompletos = [nome_objeto for nome_objeto, tamanho in objetos
+                           if not has_expected_size(object_local_path(staging, prefixo, nome_objeto), tamanho)]
+            if incompletos:
+                raise RuntimeError(f"{len(incompletos)} arquivo(s) incompleto(s); o download será retomado na próxima execução")
+            remove_unexpected_files(staging, {object_local_path(staging, prefixo, nome_objeto) for nome_objeto, _ in objetos})
+            if inventario is None:
+                os.replace(staging, destino_final)
+            else:
+                registro = ProductRecord(nome_pasta, get_tile_id(nome_pasta), get_sensing_date(nome_pasta), destino_final,
+                                         sum(tamanho for _, tamanho in objetos),
+                                         self._checksum_status(manifesto, prefixo, pendentes),
+                                         datetime.now().isoformat(timespec='seconds'))
+                inventario.add(registro, lambda: os.replace(staging, destino_final))
+        except Exception as e:
+            logging.error(f"🔥 Falha no download da pasta '{gcs_folder_uri}'. Erro: {e}")
+            if transferencia is not None:
+                transferencia.erro = e
+            return False
+        logging.info(f"✔️ Download de '{gcs_folder_uri}' para '{destino_final}' concluído com sucesso.")
+        return True
+
+class GcloudBackend(StorageBackend):
+    """Backend baseado em subprocessos da CLI 'gcloud storage'."""
+    nome = "gcloud"
+    verifica_manifesto = False
+
+    def iter_safe_folders(self, uri_base, datas=None):
+        # Um 'gcloud storage ls' que falha no meio só pode ser repetido por inteiro
+        return RETENTATIVAS.iterate(lambda: iter_available_safe_folders(uri_base, datas), f"Listagem de {uri_base}")
+
+    def read_metadata(self, safe_folder_uris):
+        return cat_metadata_files(list(safe_folder_uris))
+
+    def list_objects(self, uri_prefixo):
+        return RETENTATIVAS.call(list_objects_gcloud, uri_prefixo, descricao=f"Listagem de '{uri_prefixo}'")
+
+    def read_object(self, uri):
+        return run_gcloud(["gcloud", "storage", "cat", uri], text=False)
+
+    def object_generation(self, uri):
+        command = ["gcloud", "storage", "objects", "describe", uri, "--format=value(generation)"]
+        try:
+            geracao = RETENTATIVAS.call(run_gcloud, command, descricao=f"Consulta de '{uri}'").strip()
+        except (GcloudCommandError, OSError, subprocess.TimeoutExpired):
+            return None
+        return geracao or None
+
+    @contextmanager
+    def open_object(self, uri):
+        # O 'cat' é lido à medida que chega, sem guardar o objeto inteiro na memória
+        command = ["gcloud", "storage", "cat", uri]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=USAR_SHELL)
+        stderr_partes = []
+        leitor_stderr = threading.Thread(target=lambda: stderr_partes.append(process.stderr.read()), daemon=True)
+        leitor_stderr.start()
+        estourou = threading.Event()
+
+        def encerrar():
+            estourou.set()
+            process.kill()
+
+        prazo = threading.Timer(TIMEOUT_GCLOUD_INDICE, encerrar)
+        prazo.daemon = True
+        prazo.start()
+        try:
+            yield process.stdout
+            process.wait()
+        finally:
+            prazo.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            leitor_stderr.join()
+            process.stdout.close()
+            process.stderr.close()
+
+        # Um 'cat' que falhou entrega um fluxo vazio ou truncado; quem leu não pode tomá-lo como o objeto inteiro
+        if estourou.is_set():
+            raise subprocess.TimeoutExpired(command, TIMEOUT_GCLOUD_INDICE)
+        if process.returncode != 0:
+            raise GcloudCommandError(command, process.returncode, b"".join(stderr_partes).decode('utf-8', errors='ignore'))
+
+    def download_objects(self, gcs_folder_uri, objetos, destino, limitador=None, pasta_completa=False, manifesto=None,
+                         transferencia=None):
+        # O próprio gcloud paraleliza as transferências e valida cada arquivo contra o hash do objeto no bucket,
+        # então o manifesto não é conferido de novo aqui (isso exigiria reler os arquivos)
+        if pasta_completa:
+            sucesso = download_folder(gcs_folder_uri, destino, transferencia)
+        else:
+            sucesso = download_selected_objects(gcs_folder_uri, [nome_objeto for nome_objeto, _ in objetos], destino,
+                                                transferencia)
+        # O gcloud não aceita limite de banda: durante o rsync/cp a transferência não é limitada, e vários
+        # downloads simultâneos podem ocupar o link inteiro. Os bytes só são descontados depois, o que atrasa
+        # as transferências seguintes e aproxima a média do limite, mas não segura os picos
+        if sucesso and limitador is not None:
+            # A espera pode passar de LIMITE_SEM_PROGRESSO_S sem nenhum byte novo; não é um travamento
+            if transferencia is None:
+                limitador.consume(sum(tamanho for _, tamanho in objetos))
+            else:
+                with transferencia.paused():
+                    limitador.consume(sum(tamanho for _, tamanho in objetos))
+        return sucesso
+
+# Endpoint da API do Cloud Storage. STORAGE_EMULATOR_HOST (mesma variável das bibliotecas oficiais)
+# aponta o script para um servidor GCS falso local, para rodar o pipeline inteiro offline.
+GCS_ENDPOINT = os.environ.get("STORAGE_EMULATOR_HOST") or "https://storage.googleapis.com"
+MAX_CONEXOES_HTTP = 16 # Conexões keep-alive mantidas abertas com a API
+TIMEOUT_HTTP = 60 # Segundos
+TAMANHO_BLOCO_DOWNLOAD = 1024 * 1024 # Bytes lidos por vez ao gravar arquivos baixados
+
+# Prefixos de missão usados para restringir a listagem por data na API JSON (que não aceita curingas)
+MISSOES_SENTINEL2 = ("S2A", "S2B", "S2C")
+
+# Até esse número de dias, a API é consultada com um prefixo por dia em vez de um por mês
+MAX_PREFIXOS_DIARIOS = 5
+
+class GcsHttpError(Exception):
+    """Resposta de erro da API do Cloud Storage."""
+
+    def __init__(self, status, mensagem, retry_after=None):
+        super().__init__(f"HTTP {status}: {mensagem}")
+        self.status = status
+        self.retry_after = retry_after # Segundos sugeridos pelo servidor antes de tentar de novo
+
+def split_gcs_uri(uri):
+    """Separa 'gs://bucket/caminho' em ('bucket', 'caminho')."""
+    bucket, _, nome_objeto = uri[len("gs://"):].partition("/")
+    return bucket, nome_objeto
+
+class HttpConnectionPool:
+    """
+    Pool de conexões HTTP(S) keep-alive para um único host. Cada requisição usa uma conexão livre
+    (ou abre uma nova, até o limite) e a devolve ao final, evitando um handshake TLS por operação.
+    """
+
+    def __init__(self, endpoint, max_conexoes=MAX_CONEXOES_HTTP, timeout=TIMEOUT_HTTP):
+        partes = urllib.parse.urlsplit(endpoint if "://" in endpoint else f"http://{endpoint}")
+        self.classe_conexao = http.client.HTTPSConnection if partes.scheme == "https" else http.client.HTTPConnection
+        self.host = partes.netloc
+        self.caminho_base = partes.path.rstrip("/")
+        self.timeout = timeout
+        self._livres = queue.LifoQueue()
+        self._vagas = threading.BoundedSemaphore(max(1, max_conexoes))
 
-        # Loop que percorre as pastas no site
-        for pasta_uri in pastas_disponiveis:
+    def _send(self, method, path, headers):
+        while True:
             try:
-                nome_pasta = os.path.basename(pasta_uri.strip('/'))
-                match = re.search(r'_(\d{8})T', nome_pasta)
-                
-                if not match:
+                conexao, reutilizada = self._livres.get_nowait(), True
+            except queue.Empty:
+                conexao, reutilizada = self.classe_conexao(self.host, timeout=self.timeout), False
+            try:
+                conexao.request(method, self.caminho_base + path, headers=headers)
+                return conexao, conexao.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # O servidor pode ter fechado uma conexão ociosa; só desiste se a conexão era nova
+                conexao.close()
+                if not reutilizada:
+                    raise
+
+    @contextmanager
+    def request(self, method, path, headers=None):
+        """Executa a requisição e entrega a resposta; o corpo deve ser consumido dentro do bloco 'with'."""
+        with self._vagas:
+            conexao, resposta = self._send(method, path, headers or {})
+            try:
+                yield resposta
+                resposta.read() # Descarta o que sobrou para que a conexão possa ser reutilizada
+            except BaseException:
+                conexao.close()
+                raise
+            if resposta.will_close:
+                conexao.close()
+            else:
+                self._livres.put(conexao)
+
+    def close(self):
+        while True:
+            try:
+                self._livres.get_nowait().close()
+            except queue.Empty:
+                return
+
+class GcsHttpBackend(StorageBackend):
+    """Backend que acessa o bucket público direto pela API JSON do Cloud Storage, sem autenticação."""
+    nome = "http"
+
+    def __init__(self, endpoint=GCS_ENDPOINT, max_conexoes=MAX_CONEXOES_HTTP):
+        self.max_conexoes = max_conexoes
+        self.pool = HttpConnectionPool(endpoint, max_conexoes)
+
+    @staticmethod
+    def _check(resposta):
+        if resposta.status >= 400:
+            retry_after = resposta.getheader("Retry-After")
+            raise GcsHttpError(resposta.status, resposta.read(500).decode('utf-8', errors='ignore'),
+                               float(retry_after) if retry_after and retry_after.isdigit() else None)
+
+    @staticmethod
+    def _media_path(bucket, nome_objeto):
+        return f"/storage/v1/b/{bucket}/o/{urllib.parse.quote(nome_objeto, safe='')}?alt=media"
+
+    def _get_json(self, path):
+        with self.pool.request("GET", path) as resposta:
+            self._check(resposta)
+            return json.loads(resposta.read())
+
+    def _list_pages(self, bucket, prefixo, delimiter=None, fields=None):
+        """Percorre as páginas do 'objects.list', devolvendo o JSON de cada uma."""
+        params = {"prefix": prefixo}
+        if delimiter:
+            params["delimiter"] = delimiter
+        if fields:
+            params["fields"] = fields
+        while True:
+            path = f"/storage/v1/b/{bucket}/o?{urllib.parse.urlencode(params)}"
+            # Cada página é repetida isoladamente, sem recomeçar a listagem
+            pagina = RETENTATIVAS.call(self._get_json, path, descricao=f"Listagem de gs://{bucket}/{prefixo}")
+            yield pagina
+            if not pagina.get("nextPageToken"):
+                return
+            params["pageToken"] = pagina["nextPageToken"]
+
+    def probe(self):
+        """Verifica se a API responde, listando um único item do bucket."""
+        bucket, prefixo = split_gcs_uri(f"{BUCKET_BASE_URI}/")
+        path = f"/storage/v1/b/{bucket}/o?{urllib.parse.urlencode({'prefix': prefixo, 'maxResults': 1})}"
+        try:
+            RETENTATIVAS.call(self._get_json, path, descricao=f"Acesso à API em {GCS_ENDPOINT}")
+            return True
+        except (GcsHttpError, OSError, http.client.HTTPException) as e:
+            logging.warning(f"⚠️ API do Cloud Storage indisponível em {GCS_ENDPOINT}: {e}")
+            return False
+
+    def iter_safe_folders(self, uri_base, datas=None):
+        bucket, prefixo_tile = split_gcs_uri(uri_base)
+        if datas and len(datas) <= MAX_PREFIXOS_DIARIOS:
+            # Poucos dias (ex.: só os posteriores à marca do tile): um prefixo por missão e dia
+            prefixos = [f"{prefixo_tile}{missao}_MSIL2A_{data}" for missao in MISSOES_SENTINEL2 for data in sorted(datas)]
+            logging.info(f"📂 Listando {len(datas)} dia(s) de produtos em: {uri_base}")
+        elif datas:
+            # Um prefixo por missão e mês da janela; as datas exatas são filtradas abaixo
+            meses = sorted({data[:6] for data in datas})
+            prefixos = [f"{prefixo_tile}{missao}_MSIL2A_{mes}" for missao in MISSOES_SENTINEL2 for mes in meses]
+            logging.info(f"📂 Listando {len(meses)} mês(es) de produtos em: {uri_base}")
+        else:
+            prefixos = [prefixo_tile]
+            logging.info(f"📂 Listando todo o conteúdo de: {uri_base}")
+
+        # Cada página é entregue assim que chega, sem esperar o fim da listagem. Um tile inexistente só
+        # devolve páginas vazias; qualquer erro (403, JSON inválido...) é propagado para quem chamou
+        encontradas = 0
+        for prefixo in prefixos:
+            for pagina in self._list_pages(bucket, prefixo, delimiter="/", fields="prefixes,nextPageToken"):
+                for pasta in pagina.get("prefixes", []):
+                    if not pasta.endswith(".SAFE/"):
+                        continue
+                    produto = make_safe_product(f"gs://{bucket}/{pasta}")
+                    if datas and produto.data_sensor not in datas:
+                        continue
+                    encontradas += 1
+                    yield produto
+
+        if encontradas:
+            logging.info(f"✔️ Encontradas {encontradas} pastas .SAFE para análise.")
+        else:
+            logging.info("➡️ Nenhuma pasta .SAFE encontrada neste diretório.")
+
+    def read_object(self, uri):
+        """Lê um objeto inteiro para a memória."""
+        bucket, nome_objeto = split_gcs_uri(uri)
+        with self.pool.request("GET", self._media_path(bucket, nome_objeto)) as resposta:
+            self._check(resposta)
+            return resposta.read()
+
+    @contextmanager
+    def open_object(self, uri):
+        bucket, nome_objeto = split_gcs_uri(uri)
+        with self.pool.request("GET", self._media_path(bucket, nome_objeto)) as resposta:
+            self._check(resposta)
+            yield resposta
+
+    def object_generation(self, uri):
+        bucket, nome_objeto = split_gcs_uri(uri)
+        path = f"/storage/v1/b/{bucket}/o/{urllib.parse.quote(nome_objeto, safe='')}?fields=generation"
+        try:
+            return RETENTATIVAS.call(self._get_json, path, descricao=f"Consulta de '{uri}'").get("generation")
+        except (GcsHttpError, OSError, http.client.HTTPException, ValueError):
+            return None
+
+    def _read_metadata_file(self, safe_folder_uri):
+        metadata_file_uri = f"{safe_folder_uri}{METADATA_FILENAME}"
+        try:
+            return RETENTATIVAS.call(self.read_object, metadata_file_uri, descricao=f"Leitura de '{metadata_file_uri}'")
+        except (GcsHttpError, OSError, http.client.HTTPException) as e:
+            logging.error(f"🔥 Falha ao baixar o arquivo de metadados '{metadata_file_uri}'. Erro: {e}")
+            return None
+
+    def read_metadata(self, safe_folder_uris):
+        safe_folder_uris = list(safe_folder_uris)
+        logging.info(f"🔎 Verificando cobertura de nuvens de {len(safe_folder_uris)} produto(s) via API.")
+        with ThreadPoolExecutor(max_workers=self.max_conexoes) as executor:
+            conteudos = executor.map(self._read_metadata_file, safe_folder_uris)
+            return {uri: conteudo for uri, conteudo in zip(safe_folder_uris, conteudos) if conteudo is not None}
+
+    def list_objects(self, uri_prefixo):
+        """Lista recursivamente os objetos sob um prefixo. Retorna [(nome_do_objeto, tamanho_em_bytes)]."""
+        bucket, prefixo = split_gcs_uri(uri_prefixo)
+        objetos = []
+        for pagina in self._list_pages(bucket, prefixo, fields="items(name,size),nextPageToken"):
+            objetos.extend((item["name"], int(item.get("size", 0))) for item in pagina.get("items", []))
+        return objetos
+
+    def download_object(self, uri, caminho_local, limitador=None, entrada_manifesto=None):
+        bucket, nome_objeto = split_gcs_uri(uri)
+        with self.pool.request("GET", self._media_path(bucket, nome_objeto)) as resposta:
+            self._check(resposta)
+            write_verified(resposta, caminho_local, limitador, entrada_manifesto)
+
+# Raiz de um espelho local (ou montado via NFS) do diretório L2/tiles do bucket
+DIRETORIO_ESPELHO = os.environ.get("SENTINEL_MIRROR_DIR", "")
+
+class LocalMirrorBackend(StorageBackend):
+    """
+    Backend que lê de uma cópia em disco do bucket, com o mesmo layout de L2/tiles/<zona>/<banda>/<quadrado>/.
+    As URIs gs:// continuam sendo usadas externamente e são traduzidas para caminhos sob 'raiz'.
+    """
+    nome = "local"
+
+    def __init__(self, raiz=DIRETORIO_ESPELHO):
+        self.raiz = os.path.normpath(raiz)
+
+    def local_path(self, uri):
+        """Traduz uma URI sob BUCKET_BASE_URI para o caminho equivalente no espelho."""
+        if not uri.startswith(f"{BUCKET_BASE_URI}/"):
+            raise ValueError(f"URI fora de {BUCKET_BASE_URI}: {uri}")
+        relativo = uri[len(BUCKET_BASE_URI) + 1:].strip("/")
+        return os.path.join(self.raiz, *relativo.split("/")) if relativo else self.raiz
+
+    def iter_safe_folders(self, uri_base, datas=None):
+        logging.info(f"📂 Listando o espelho local de: {uri_base}")
+        encontradas = 0
+        try:
+            with os.scandir(self.local_path(uri_base)) as entradas:
+                for entrada in entradas:
+                    if not entrada.name.endswith(".SAFE") or not entrada.is_dir():
+                        continue
+                    produto = make_safe_product(f"{uri_base}{entrada.name}/")
+                    if datas and produto.data_sensor not in datas:
+                        continue
+                    encontradas += 1
+                    yield produto
+        except FileNotFoundError:
+            # Tile ausente do espelho: listagem vazia. Outros erros de disco (permissão, NFS...) são propagados
+            logging.info(f"➡️ Nenhuma pasta .SAFE encontrada em {uri_base}.")
+            return
+
+        if encontradas:
+            logging.info(f"✔️ Encontradas {encontradas} pastas .SAFE para análise.")
+        else:
+            logging.info("➡️ Nenhuma pasta .SAFE encontrada neste diretório.")
+
+    def read_metadata(self, safe_folder_uris):
+        documentos = {}
+        for safe_folder_uri in safe_folder_uris:
+            metadata_file_uri = f"{safe_folder_uri}{METADATA_FILENAME}"
+            try:
+                with open(self.local_path(metadata_file_uri), "rb") as arquivo:
+                    documentos[safe_folder_uri] = arquivo.read()
+            except OSError as e:
+                logging.error(f"🔥 Falha ao ler o arquivo de metadados '{metadata_file_uri}'. Erro: {e}")
+        return documentos
+
+    def list_objects(self, uri_prefixo):
+        """Lista recursivamente os arquivos sob um prefixo. Retorna [(nome_do_objeto, tamanho_em_bytes)] como no bucket."""
+        _, prefixo = split_gcs_uri(uri_prefixo)
+        origem = self.local_path(uri_prefixo)
+        objetos = []
+        for pasta, _, arquivos in os.walk(origem):
+            for nome_arquivo in arquivos:
+                caminho = os.path.join(pasta, nome_arquivo)
+                relativo = os.path.relpath(caminho, origem).replace(os.sep, "/")
+                objetos.append((f"{prefixo}{relativo}", os.path.getsize(caminho)))
+        return sorted(objetos)
+
+    def read_object(self, uri):
+        with open(self.local_path(uri), "rb") as arquivo:
+            return arquivo.read()
+
+    @contextmanager
+    def open_object(self, uri):
+        with open(self.local_path(uri), "rb") as arquivo:
+            yield arquivo
+
+    def object_generation(self, uri):
+        return file_generation(self.local_path(uri))
+
+    def listing_generation(self, uri_base):
+        # A data de modificação da pasta do tile muda quando uma pasta .SAFE é criada, removida ou renomeada
+        try:
+            return file_generation(self.local_path(uri_base))
+        except (OSError, ValueError):
+            return None
+
+    def download_object(self, uri, caminho_local, limitador=None, entrada_manifesto=None):
+        with open(self.local_path(uri), "rb") as origem:
+            write_verified(origem, caminho_local, limitador, entrada_manifesto)
+
+# Backend usado por padrão: 'http' (API JSON, com gcloud como alternativa), 'gcloud' ou 'local'
+BACKEND_ARMAZENAMENTO = os.environ.get("SENTINEL_BACKEND", "http")
+
+def create_backend(nome=BACKEND_ARMAZENAMENTO):
+    """Cria o backend pedido. Se a API HTTP não responder, recorre ao gcloud. Retorna None se nenhum estiver disponível."""
+    if nome == "http":
+        backend = GcsHttpBackend()
+        if backend.probe():
+            logging.info(f"✅ Acessando o bucket pela API em {GCS_ENDPOINT}.")
+            return backend
+        logging.warning("➡️ Usando a CLI gcloud como alternativa.")
+        nome = "gcloud"
+    if nome == "gcloud":
+        return GcloudBackend() if check_gcloud_availability() else None
+    if nome == "local":
+        if not os.path.isdir(DIRETORIO_ESPELHO):
+            logging.error(f"🔥 Espelho local não encontrado: '{DIRETORIO_ESPELHO}'. Defina SENTINEL_MIRROR_DIR.")
+            return None
+        logging.info(f"✅ Lendo os produtos do espelho local em {DIRETORIO_ESPELHO}.")
+        return LocalMirrorBackend()
+    logging.error(f"🔥 Backend de armazenamento desconhecido: '{nome}'.")
+    return None
+
+# --- Cache Persistente de Metadados ---
+DIRETORIO_ESTADO = "estado" # Pasta com o banco SQLite de estado entre execuções
+ARQUIVO_ESTADO = os.path.join(DIRETORIO_ESTADO, "sentinel_ws.sqlite")
+
+class StateDatabase:
+    """Conexão SQLite única do script, compartilhada entre threads e protegida por um lock."""
+
+    def __init__(self, caminho=ARQUIVO_ESTADO):
+        os.makedirs(os.path.dirname(caminho) or ".", exist_ok=True)
+        self.caminho = caminho
+        self.conexao = sqlite3.connect(caminho, check_same_thread=False)
+        self.lock = threading.RLock()
+
+    def execute(self, sql, parametros=()):
+        """Executa um comando em sua própria transação e retorna todas as linhas do resultado."""
+        with self.lock, self.conexao:
+            return self.conexao.execute(sql, parametros).fetchall()
+
+    def executemany(self, sql, sequencia):
+        with self.lock, self.conexao:
+            self.conexao.executemany(sql, sequencia)
+
+    def close(self):
+        with self.lock:
+            self.conexao.close()
+
+class MetadataCache:
+    """
+    Guarda a cobertura de nuvens já extraída de cada produto, para que cenas já avaliadas
+    (inclusive as rejeitadas, que nunca ganham pasta local) não sejam baixadas de novo.
+    """
+
+    def __init__(self, banco):
+        self.banco = banco
+        self.banco.execute(
+            """CREATE TABLE IF NOT EXISTS metadata_cache (
+                   produto TEXT PRIMARY KEY,
+                   data_sensor TEXT,
+                   cloud_cover REAL NOT NULL,
+                   tag TEXT NOT NULL,
+                   obtido_em TEXT NOT NULL)""")
+        self.banco.execute("CREATE INDEX IF NOT EXISTS idx_metadata_cache_data ON metadata_cache (data_sensor)")
+
+    def get(self, nome_produto):
+        """Retorna (cloud_cover, tag) do produto ou None se ele ainda não foi avaliado."""
+        linhas = self.banco.execute("SELECT cloud_cover, tag FROM metadata_cache WHERE produto = ?", (nome_produto,))
+        return linhas[0] if linhas else None
+
+    def put(self, nome_produto, data_sensor, cloud_cover, tag_name):
+        self.banco.execute(
+            "INSERT OR REPLACE INTO metadata_cache (produto, data_sensor, cloud_cover, tag, obtido_em) VALUES (?, ?, ?, ?, ?)",
+            (nome_produto, data_sensor, cloud_cover, tag_name, datetime.now().isoformat(timespec='seconds')))
+
+    def evict_outside(self, datas):
+        """Remove do cache os produtos cuja data de aquisição está fora da janela de datas."""
+        if not datas:
+            return 0
+        with self.banco.lock:
+            removidos = self.banco.execute("SELECT COUNT(*) FROM metadata_cache WHERE data_sensor IS NULL OR data_sensor NOT BETWEEN ? AND ?",
+                                           (min(datas), max(datas)))[0][0]
+            self.banco.execute("DELETE FROM metadata_cache WHERE data_sensor IS NULL OR data_sensor NOT BETWEEN ? AND ?",
+                               (min(datas), max(datas)))
+        if removidos:
+            logging.info(f"🧹 {removidos} produto(s) fora da janela removido(s) do cache de metadados.")
+        return removidos
+
+# --- Cache de Listagens ---
+TTL_CACHE_LISTAGEM_S = 3600 # Por quanto tempo a listagem de um tile é reaproveitada sem consultar o bucket (0 = sem cache)
+
+class ListingCache:
+    """
+    Guarda a última listagem completa de cada tile (URIs das pastas .SAFE e dias listados), para que execuções
+    próximas umas das outras não listem o bucket de novo. Uma entrada é reaproveitada por até 'ttl' segundos.
+    Se o backend informar a versão da listagem (listing_generation), ela precisa conferir com a da entrada,
+    e uma versão igual renova a entrada mesmo depois do TTL.
+    """
+
+    def __init__(self, banco, ttl=TTL_CACHE_LISTAGEM_S):
+        self.banco = banco
+        self.ttl = ttl
+        self.banco.execute(
+            """CREATE TABLE IF NOT EXISTS cache_listagem (
+                   uri TEXT PRIMARY KEY,
+                   datas TEXT,
+                   produtos TEXT NOT NULL,
+                   geracao TEXT,
+                   listado_em TEXT NOT NULL)""")
+
+    def _lookup(self, uri_base, datas, geracao):
+        """Retorna as URIs em cache que atendem à consulta, ou None se for preciso listar o tile de novo."""
+        linhas = self.banco.execute("SELECT datas, produtos, geracao, listado_em FROM cache_listagem WHERE uri = ?",
+                                    (uri_base,))
+        if not linhas:
+            return None
+        datas_salvas, produtos, geracao_salva, listado_em = linhas[0]
+        # A entrada precisa cobrir todos os dias pedidos; uma listagem sem datas cobre qualquer janela
+        if datas_salvas is not None and (not datas or not set(datas) <= set(json.loads(datas_salvas))):
+            return None
+        idade = (datetime.now() - datetime.fromisoformat(listado_em)).total_seconds()
+        if geracao is not None and geracao != geracao_salva:
+            return None
+        if idade > self.ttl:
+            if geracao is None:
+                return None
+            # Tile inalterado desde a última listagem: renova a entrada sem listar
+            self.banco.execute("UPDATE cache_listagem SET listado_em = ? WHERE uri = ?",
+                               (datetime.now().isoformat(timespec='seconds'), uri_base))
+        uris = json.loads(produtos)
+        if datas:
+            uris = ProductTable.from_uris(uris).filter(datas=datas).uris
+        return uris
+
+    def iter_safe_folders(self, backend, uri_base, datas=None):
+        """
+        Gera um SafeProduct por pasta .SAFE/ do tile, vindo do cache quando possível. Caso contrário lista
+        pelo backend e guarda o resultado, desde que a listagem tenha sido consumida até o fim.
+        Os backends propagam os erros de listagem em vez de terminar a listagem vazia, então uma listagem
+        que falhou nunca chega a ser guardada.
+        """
+        geracao = backend.listing_generation(uri_base) # Lida antes, para que mudanças durante a listagem invalidem a entrada
+        uris = self._lookup(uri_base, datas, geracao)
+        if uris is not None:
+            logging.info(f"💾 Listagem de {uri_base} reaproveitada do cache: {len(uris)} pasta(s) .SAFE.")
+            for uri in uris:
+                yield make_safe_product(uri)
+            return
+
+        uris = []
+        for produto in backend.iter_safe_folders(uri_base, datas):
+            uris.append(produto.uri)
+            yield produto
+        self.banco.execute(
+            "INSERT OR REPLACE INTO cache_listagem (uri, datas, produtos, geracao, listado_em) VALUES (?, ?, ?, ?, ?)",
+            (uri_base, json.dumps(sorted(datas)) if datas else None, json.dumps(uris), geracao,
+             datetime.now().isoformat(timespec='seconds')))
+
+# --- Inventário Local ---
+# Como os arquivos de um produto do inventário foram verificados
+STATUS_VERIFICADO = "verificado" # Todos conferidos com o manifest.safe durante a gravação
+STATUS_PARCIAL = "parcial" # Algum arquivo (além do próprio manifest.safe) não constava do manifesto; só o tamanho foi conferido
+STATUS_SEM_MANIFESTO = "sem_manifesto" # manifest.safe indisponível; só o tamanho foi conferido
+STATUS_HASH_BUCKET = "hash_bucket" # Validados pelo gcloud contra o hash do objeto no bucket
+STATUS_NAO_VERIFICADO = "nao_verificado" # Encontrado no disco pela reconciliação
+
+# Produto presente em Output_GCS
+ProductRecord = namedtuple("ProductRecord", ["produto", "tile", "data_sensor", "caminho", "bytes",
+                                             "checksum_status", "baixado_em"])
+
+class Inventory:
+    """
+    Índice dos produtos já baixados. É carregado para a memória uma vez por execução, para que a
+    checagem "já temos este produto?" não custe um stat no disco (caro em NFS), e é atualizado pelo
+    downloader na mesma transação em que a pasta do produto é promovida.
+    """
+
+    def __init__(self, banco):
+        self.banco = banco
+        self.banco.execute(
+            """CREATE TABLE IF NOT EXISTS inventario (
+                   produto TEXT PRIMARY KEY,
+                   tile TEXT,
+                   data_sensor TEXT,
+                   caminho TEXT NOT NULL,
+                   bytes INTEGER NOT NULL,
+                   checksum_status TEXT NOT NULL,
+                   baixado_em TEXT NOT NULL)""")
+        self.banco.execute("CREATE INDEX IF NOT EXISTS idx_inventario_tile_data ON inventario (tile, data_sensor)")
+        self._produtos = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Carrega o inventário inteiro para a memória. Retorna o número de produtos."""
+        linhas = self.banco.execute(f"SELECT {', '.join(ProductRecord._fields)} FROM inventario")
+        with self._lock:
+            self._produtos = {linha[0]: ProductRecord(*linha) for linha in linhas}
+            return len(self._produtos)
+
+    def __contains__(self, nome_produto):
+        with self._lock:
+            return nome_produto in self._produtos
+
+    def __len__(self):
+        with self._lock:
+            return len(self._produtos)
+
+    def get(self, nome_produto):
+        with self._lock:
+            return self._produtos.get(nome_produto)
+
+    def records(self):
+        with self._lock:
+            return list(self._produtos.values())
+
+    def remove(self, nome_produto, acao=None):
+        """Remove um produto do inventário. Assim como em add(), 'acao' roda dentro da transação."""
+        with self.banco.lock, self.banco.conexao:
+            self.banco.conexao.execute("DELETE FROM inventario WHERE produto = ?", (nome_produto,))
+            if acao is not None:
+                acao()
+        with self._lock:
+            self._produtos.pop(nome_produto, None)
+
+    def add(self, registro, acao=None):
+        """
+        Registra um produto. Se 'acao' for informada (ex.: o rename do staging), ela roda dentro da
+        transação: se falhar, o registro é desfeito, e se não rodar, o registro nunca é gravado.
+        """
+        with self.banco.lock, self.banco.conexao:
+            self.banco.conexao.execute(
+                f"INSERT OR REPLACE INTO inventario ({', '.join(ProductRecord._fields)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                tuple(registro))
+            if acao is not None:
+                acao()
+        with self._lock:
+            self._produtos[registro.produto] = registro
+
+    def reconcile(self, diretorio_base=DIRETORIO_OUTPUT_BASE):
+        """
+        Reconstrói o inventário a partir de uma varredura de <base>/<zona>/<banda>/<quadrado>/*.SAFE.
+        Produtos já conhecidos mantêm status e data de download; os novos entram como não verificados,
+        e os que sumiram do disco são removidos. Retorna (adicionados, removidos).
+        """
+        encontrados = {}
+        for caminho in glob.glob(os.path.join(diretorio_base, "*", "*", "*", "*.SAFE")):
+            if not os.path.isdir(caminho):
+                continue
+            nome_pasta = os.path.basename(caminho)
+            anterior = self.get(nome_pasta)
+            encontrados[nome_pasta] = ProductRecord(
+                nome_pasta, get_tile_id(nome_pasta), get_sensing_date(nome_pasta), caminho, get_dir_size(caminho),
+                anterior.checksum_status if anterior else STATUS_NAO_VERIFICADO,
+                anterior.baixado_em if anterior else datetime.fromtimestamp(os.path.getmtime(caminho)).isoformat(timespec='seconds'))
+
+        with self.banco.lock, self.banco.conexao:
+            conhecidos = {linha[0] for linha in self.banco.conexao.execute("SELECT produto FROM inventario")}
+            self.banco.conexao.execute("DELETE FROM inventario")
+            self.banco.conexao.executemany(
+                f"INSERT INTO inventario ({', '.join(ProductRecord._fields)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [tuple(registro) for registro in encontrados.values()])
+        with self._lock:
+            self._produtos = encontrados
+
+        adicionados, removidos = len(set(encontrados) - conhecidos), len(conhecidos - set(encontrados))
+        logging.info(f"🗂️ Inventário reconciliado: {len(encontrados)} produto(s) no disco, "
+                     f"{adicionados} adicionado(s), {removidos} removido(s).")
+        return adicionados, removidos
+
+# --- Fila Persistente de Falhas ---
+MAX_TENTATIVAS_FILA = 5 # Execuções que tentam de novo uma operação antes de desistir dela
+
+# Operações que podem falhar, na ordem em que são retomadas no início de uma execução
+FALHA_DOWNLOAD = "download"
+FALHA_METADADOS = "metadados"
+FALHA_LISTAGEM = "listagem"
+ORDEM_FALHAS = (FALHA_DOWNLOAD, FALHA_METADADOS, FALHA_LISTAGEM)
+
+# Falha pendente: 'uri' é a pasta .SAFE (download/metadados) ou o diretório do tile (listagem);
+# 'datas' são as datas pedidas na listagem que falhou
+FailureEntry = namedtuple("FailureEntry", ["tipo", "uri", "codigo", "datas", "tentativas", "ultimo_erro"])
+
+class FailureQueue:
+    """
+    Fila durável das listagens, verificações de metadados e downloads que falharam, com o número de
+    tentativas e o último erro. Cada execução retoma a fila antes do trabalho novo; depois de
+    'max_tentativas' falhas a operação é marcada como abandonada e sai da fila.
+    """
+
+    def __init__(self, banco, max_tentativas=MAX_TENTATIVAS_FILA):
+        self.banco = banco
+        self.max_tentativas = max(1, max_tentativas)
+        self.banco.execute(
+            """CREATE TABLE IF NOT EXISTS fila_falhas (
+                   tipo TEXT NOT NULL,
+                   uri TEXT NOT NULL,
+                   codigo TEXT NOT NULL,
+                   datas TEXT NOT NULL DEFAULT '',
+                   tentativas INTEGER NOT NULL,
+                   ultimo_erro TEXT,
+                   primeira_falha TEXT NOT NULL,
+                   ultima_falha TEXT NOT NULL,
+                   abandonada INTEGER NOT NULL DEFAULT 0,
+                   PRIMARY KEY (tipo, uri))""")
+
+    def record(self, tipo, uri, codigo, erro, datas=()):
+        """Registra mais uma falha da operação. Retorna True se ela ainda será tentada de novo."""
+        agora = datetime.now().isoformat(timespec='seconds')
+        with self.banco.lock, self.banco.conexao:
+            linha = self.banco.conexao.execute(
+                "SELECT tentativas, datas FROM fila_falhas WHERE tipo = ? AND uri = ?", (tipo, uri)).fetchone()
+            tentativas = (linha[0] if linha else 0) + 1
+            # Uma listagem que falha de novo acumula as datas das execuções anteriores
+            todas_datas = set(datas) | set(filter(None, (linha[1] if linha else "").split(",")))
+            abandonada = tentativas >= self.max_tentativas
+            self.banco.conexao.execute(
+                """INSERT INTO fila_falhas (tipo, uri, codigo, datas, tentativas, ultimo_erro, primeira_falha, ultima_falha, abandonada)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (tipo, uri) DO UPDATE SET datas = excluded.datas, tentativas = excluded.tentativas,
+                       ultimo_erro = excluded.ultimo_erro, ultima_falha = excluded.ultima_falha, abandonada = excluded.abandonada""",
+                (tipo, uri, "/".join(codigo), ",".join(sorted(todas_datas)), tentativas, str(erro)[:1000],
+                 agora, agora, int(abandonada)))
+        if abandonada:
+            logging.error(f"🪦 {tipo.capitalize()} de '{uri}' falhou {tentativas} vez(es); desistindo. Último erro: {erro}")
+        return not abandonada
+
+    def resolve(self, tipo, uri):
+        """Tira a operação da fila depois que ela deu certo."""
+        self.banco.execute("DELETE FROM fila_falhas WHERE tipo = ? AND uri = ?", (tipo, uri))
+
+    def pending(self):
+        """Falhas ainda não abandonadas, downloads primeiro, das mais antigas para as mais recentes."""
+        linhas = self.banco.execute(
+            "SELECT tipo, uri, codigo, datas, tentativas, ultimo_erro FROM fila_falhas WHERE abandonada = 0 "
+            "ORDER BY primeira_falha")
+        entradas = [FailureEntry(tipo, uri, codigo.split("/"), [data for data in datas.split(",") if data], tentativas, erro)
+                    for tipo, uri, codigo, datas, tentativas, erro in linhas]
+        return sorted(entradas, key=lambda entrada: ORDEM_FALHAS.index(entrada.tipo))
+
+# --- Marcas de Listagem por Tile ---
+RECONCILIACAO_DIAS = 7 # A cada tantos dias cada tile é listado por inteiro, ignorando a marca
+
+# Um produto pode chegar ao bucket dias depois da aquisição, quando a marca já passou por ele; os dias
+# anteriores à marca dentro dessa margem continuam sendo listados, e deles só passam os produtos ainda não vistos
+ATRASO_PUBLICACAO_DIAS = 2
+
+class TileWatermarks:
+    """
+    Guarda, por tile, o produto mais recente (data/hora de aquisição e nome) já processado pela listagem,
+    e os nomes já vistos dentro da margem de atraso de publicação. As execuções seguintes só listam os dias
+    a partir da marca (menos a margem) e só deixam passar produtos posteriores a ela ou ainda não vistos.
+    Periodicamente o tile é listado por inteiro, para pegar produtos reprocessados com datas antigas.
+    """
+
+    def __init__(self, banco, reconciliacao_dias=RECONCILIACAO_DIAS, reconciliar_tudo=False):
+        self.banco = banco
+        self.reconciliacao_dias = reconciliacao_dias
+        self.banco.execute(
+            """CREATE TABLE IF NOT EXISTS marcas_listagem (
+                   tile TEXT PRIMARY KEY,
+                   aquisicao TEXT NOT NULL,
+                   produto TEXT NOT NULL,
+                   reconciliado_em TEXT)""")
+        self.banco.execute(
+            """CREATE TABLE IF NOT EXISTS marcas_vistos (
+                   tile TEXT NOT NULL,
+                   produto TEXT NOT NULL,
+                   data_sensor TEXT NOT NULL,
+                   PRIMARY KEY (tile, produto))""")
+        self._marcas = {}
+        self._reconciliado_em = {}
+        for tile, aquisicao, produto, reconciliado_em in self.banco.execute(
+                "SELECT tile, aquisicao, produto, reconciliado_em FROM marcas_listagem"):
+            self._marcas[tile] = (aquisicao, produto)
+            self._reconciliado_em[tile] = reconciliado_em
+        limite = (datetime.now() - timedelta(days=reconciliacao_dias)).isoformat(timespec='seconds')
+        # Tiles que serão listados por inteiro nesta execução
+        self.reconciliando = {tile for tile in self._marcas if reconciliar_tudo or (self._reconciliado_em[tile] or "") < limite}
+        self._vistos = {}
+        for tile, produto in self.banco.execute("SELECT tile, produto FROM marcas_vistos"):
+            self._vistos.setdefault(tile, set()).add(produto)
+        self._novas = {}
+        self._vistos_novos = {}
+        self._lock = threading.Lock()
+
+    def _full(self, tile):
+        return tile not in self._marcas or tile in self.reconciliando
+
+    @staticmethod
+    def _margin_start(aquisicao):
+        """Primeiro dia da margem de atraso de publicação de uma marca."""
+        dia_marca = datetime.strptime(aquisicao[:8], '%Y%m%d')
+        return (dia_marca - timedelta(days=ATRASO_PUBLICACAO_DIAS)).strftime('%Y%m%d')
+
+    def _first_day(self, tile):
+        return self._margin_start(self._marcas[tile][0])
+
+    def dates_to_list(self, tile, datas):
+        """Dias da janela que precisam ser listados para o tile: a partir do dia da marca (menos a margem), ou todos se for reconciliar."""
+        if self._full(tile):
+            return sorted(datas)
+        primeiro_dia = self._first_day(tile)
+        return sorted(data for data in datas if data >= primeiro_dia) or sorted(datas)[-1:]
+
+    def is_new(self, tile, produto):
+        """
+        True se o produto é posterior à marca do tile, ou se está dentro da margem de atraso de publicação
+        e ainda não foi visto (publicado depois da execução que avançou a marca).
+        """
+        if self._full(tile):
+            return True
+        if (get_sensing_timestamp(produto.nome) or "", produto.nome) > self._marcas[tile]:
+            return True
+        return (produto.data_sensor or "") >= self._first_day(tile) and produto.nome not in self._vistos.get(tile, ())
+
+    def advance(self, tile, produto):
+        """Candidata o produto a nova marca do tile e o registra como visto; só vale depois de save()."""
+        chave = (get_sensing_timestamp(produto.nome) or "", produto.nome)
+        with self._lock:
+            if chave > self._novas.get(tile, self._marcas.get(tile, ("", ""))):
+                self._novas[tile] = chave
+            self._vistos_novos.setdefault(tile, []).append((tile, produto.nome, produto.data_sensor or ""))
+
+    def save(self, tiles_completos):
+        """
+        Grava as novas marcas dos tiles cuja listagem terminou sem erro; uma listagem interrompida
+        pode ter pulado produtos anteriores ao mais novo que ela viu.
+        """
+        agora = datetime.now().isoformat(timespec='seconds')
+        linhas, vistos, expirados = [], [], []
+        for tile in tiles_completos:
+            aquisicao, produto = self._novas.get(tile) or self._marcas.get(tile) or (None, None)
+            if aquisicao is None:
+                continue # Tile ainda sem nenhum produto na janela
+            reconciliado_em = agora if self._full(tile) else self._reconciliado_em.get(tile)
+            linhas.append((tile, aquisicao, produto, reconciliado_em))
+            vistos.extend(self._vistos_novos.get(tile, ()))
+            # Nomes anteriores à margem da nova marca já não são listados; não precisam mais ser lembrados
+            expirados.append((tile, self._margin_start(aquisicao)))
+        self.banco.executemany("INSERT OR REPLACE INTO marcas_listagem (tile, aquisicao, produto, reconciliado_em) "
+                               "VALUES (?, ?, ?, ?)", linhas)
+        self.banco.executemany("INSERT OR IGNORE INTO marcas_vistos (tile, produto, data_sensor) VALUES (?, ?, ?)", vistos)
+        self.banco.executemany("DELETE FROM marcas_vistos WHERE tile = ? AND data_sensor < ?", expirados)
+        return len(linhas)
+
+# --- Catálogo Local (index.csv.gz) ---
+# Índice publicado no bucket com uma linha por produto: tile, data de aquisição, nuvens e URL base
+INDEX_URI = "gs://gcp-public-data-sentinel-2/L2/index.csv.gz"
+TAMANHO_LOTE_CATALOGO = 5000 # Linhas gravadas por transação durante a ingestão
+
+# Data de aquisição na coluna SENSING_TIME, ex.: 2024-01-05T13:12:41.024Z → 20240105
+SENSING_TIME_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})')
+
+def file_generation(caminho):
+    """Versão de um arquivo local para a atualização incremental: tamanho e data de modificação."""
+    estado = os.stat(caminho)
+    return f"{estado.st_size}-{estado.st_mtime_ns}"
+
+def tile_code(tile_id):
+    """Converte um tile MGRS (ex.: 23KNQ) em [zona, banda, quadrado], o formato de 'codigos'."""
+    return [tile_id[:2], tile_id[2], tile_id[3:]]
+
+class Catalog:
+    """
+    Catálogo local dos produtos dos tiles de interesse, alimentado pelo index.csv.gz do bucket. Com ele, a
+    seleção de candidatos vira uma consulta por tile e data, sem listagens nem leitura de MTD_MSIL2A.xml.
+    O índice é publicado com atraso em relação ao bucket, então os produtos mais novos podem ainda não estar nele.
+    """
+
+    def __init__(self, banco):
+        self.banco = banco
+        self.banco.execute(
+            """CREATE TABLE IF NOT EXISTS catalogo (
+                   produto TEXT PRIMARY KEY,
+                   tile TEXT NOT NULL,
+                   data_sensor TEXT NOT NULL,
+                   cloud_cover REAL,
+                   total_bytes INTEGER,
+                   uri TEXT NOT NULL)""")
+        self.banco.execute("CREATE INDEX IF NOT EXISTS idx_catalogo_tile_data ON catalogo (tile, data_sensor)")
+        self.banco.execute("CREATE TABLE IF NOT EXISTS catalogo_fontes (fonte TEXT PRIMARY KEY, versao TEXT, ingerido_em TEXT)")
+
+    def __len__(self):
+        return self.banco.execute("SELECT COUNT(*) FROM catalogo")[0][0]
+
+    @staticmethod
+    def _parse_row(linha):
+        """Converte uma linha do índice em (produto, tile, data, nuvens, bytes, uri), ou None se não for um produto L2A válido."""
+        match = SENSING_TIME_PATTERN.match(linha.get("SENSING_TIME") or "")
+        base_url = (linha.get("BASE_URL") or "").rstrip("/")
+        if not match or not base_url.endswith(".SAFE"):
+            return None
+        try:
+            cloud_cover = float(linha["CLOUD_COVER"]) if linha.get("CLOUD_COVER") else None
+        except ValueError:
+            cloud_cover = None
+        total_bytes = int(linha["TOTAL_SIZE"]) if (linha.get("TOTAL_SIZE") or "").isdigit() else None
+        return (get_product_name(base_url + "/"), linha.get("MGRS_TILE", ""), "".join(match.groups()),
+                cloud_cover, total_bytes, base_url + "/")
+
+    def _write_batch(self, lote):
+        with self.banco.lock, self.banco.conexao:
+            antes = self.banco.conexao.total_changes
+            # Só reescreve as linhas que mudaram; as demais não geram escrita
+            self.banco.conexao.executemany(
+                """INSERT INTO catalogo (produto, tile, data_sensor, cloud_cover, total_bytes, uri) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (produto) DO UPDATE SET cloud_cover = excluded.cloud_cover, total_bytes = excluded.total_bytes,
+                       uri = excluded.uri
+                   WHERE catalogo.cloud_cover IS NOT excluded.cloud_cover OR catalogo.total_bytes IS NOT excluded.total_bytes
+                       OR catalogo.uri IS NOT excluded.uri""", lote)
+            return self.banco.conexao.total_changes - antes
+
+    def ingest(self, fluxo, tiles, fonte, versao=None):
+        """
+        Lê o índice (gzip) de 'fluxo' linha a linha, sem descompactá-lo inteiro, e grava os produtos dos
+        'tiles' (ex.: {"23KNQ"}) em lotes. Produtos dos tiles que sumiram do índice são removidos.
+        Retorna (lidos, gravados, removidos).
+        """
+        lidos, gravados, lote, vistos = 0, 0, [], set()
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=fluxo), encoding="utf-8", newline="") as texto:
+            for linha in csv.DictReader(texto):
+                lidos += 1
+                if lidos % 1000000 == 0:
+                    logging.info(f"📇 {lidos} linha(s) do índice lidas, {len(vistos)} produto(s) dos tiles de interesse.")
+                if linha.get("MGRS_TILE") not in tiles:
+                    continue
+                registro = self._parse_row(linha)
+                if registro is None:
+                    continue
+                vistos.add(registro[0])
+                lote.append(registro)
+                if len(lote) >= TAMANHO_LOTE_CATALOGO:
+                    gravados += self._write_batch(lote)
+                    lote = []
+        if lote:
+            gravados += self._write_batch(lote)
+        if not lidos:
+            # Um índice sem nenhuma linha é uma leitura que falhou, não um bucket vazio: nada é removido
+            # e a versão não é registrada, para que a próxima ingestão leia o índice de novo
+            logging.warning(f"⚠️ Nenhuma linha lida de '{fonte}'. Catálogo mantido como estava.")
+            return 0, 0, 0
+
+        marcadores = ",".join("?" * len(tiles))
+        existentes = self.banco.execute(f"SELECT produto FROM catalogo WHERE tile IN ({marcadores})", tuple(tiles))
+        sumidos = [(produto,) for produto, in existentes if produto not in vistos]
+        self.banco.executemany("DELETE FROM catalogo WHERE produto = ?", sumidos)
+        self.banco.execute("INSERT OR REPLACE INTO catalogo_fontes (fonte, versao, ingerido_em) VALUES (?, ?, ?)",
+                           (fonte, versao, datetime.now().isoformat(timespec='seconds')))
+        logging.info(f"📇 Catálogo atualizado a partir de '{fonte}': {lidos} linha(s) lidas, {gravados} produto(s) "
+                     f"novos ou alterados, {len(sumidos)} removido(s). Total: {len(self)} produto(s).")
+        return lidos, gravados, len(sumidos)
+
+    def stored_version(self, fonte):
+        linhas = self.banco.execute("SELECT versao FROM catalogo_fontes WHERE fonte = ?", (fonte,))
+        return linhas[0][0] if linhas else None
+
+    def refresh(self, backend, codigos_tiles, fonte=INDEX_URI, forcar=False):
+        """
+        Atualização incremental: se a versão do índice (generation no bucket; tamanho e data de um arquivo local)
+        for a mesma da última ingestão, nada é lido. 'fonte' pode ser uma URI gs:// ou o caminho de uma cópia local.
+        """
+        tiles = {"".join(codigo) for codigo in codigos_tiles}
+        local = not fonte.startswith("gs://")
+        versao = file_generation(fonte) if local else backend.object_generation(fonte)
+        if not forcar and versao is not None and versao == self.stored_version(fonte):
+            logging.info(f"📇 Catálogo já está atualizado com '{fonte}' (versão {versao}).")
+            return 0, 0, 0
+        logging.info(f"📇 Ingerindo '{fonte}' para {len(tiles)} tile(s)...")
+        if local:
+            with open(fonte, "rb") as arquivo:
+                return self.ingest(arquivo, tiles, fonte, versao)
+        with backend.open_object(fonte) as fluxo:
+            return self.ingest(fluxo, tiles, fonte, versao)
+
+    def candidates(self, codigos_tiles, datas):
+        """Gera (codigo, SafeProduct, cobertura de nuvens, total_bytes) dos produtos dos tiles nas datas pedidas, direto do catálogo."""
+        tiles = ["".join(codigo) for codigo in codigos_tiles]
+        datas = sorted(datas)
+        linhas = self.banco.execute(
+            f"SELECT tile, uri, cloud_cover, total_bytes FROM catalogo WHERE tile IN ({','.join('?' * len(tiles))}) "
+            "AND data_sensor BETWEEN ? AND ? ORDER BY tile, data_sensor",
+            (*tiles, datas[0], datas[-1]))
+        for tile, uri, cloud_cover, total_bytes in linhas:
+            produto = make_safe_product(uri)
+            if produto.data_sensor in datas:
+                yield tile_code(tile), produto, cloud_cover, total_bytes
+
+# --- Retenção de Produtos ---
+RETENCAO_MAX_DIAS = 0 # Produtos com data de aquisição mais antiga que isso são removidos (0 = sem limite)
+ORCAMENTO_DISCO_BYTES = 0 # Tamanho máximo de Output_GCS (0 = sem limite)
+
+# Ordem de remoção quando o orçamento é excedido: "antigos" (data de aquisição) ou "lru" (último acesso)
+POLITICA_RETENCAO = "antigos"
+SUFIXO_REMOCAO = ".removendo" # Pasta renomeada e fora do inventário, aguardando ser apagada
+
+class RetentionManager:
+    """
+    Aplica a retenção de Output_GCS antes dos downloads: remove produtos mais antigos que
+    'max_dias' e, se o total ainda passar de 'orcamento_bytes', remove pela política escolhida
+    até caber. O inventário é a fonte dos tamanhos e é atualizado a cada remoção.
+    """
+
+    def __init__(self, inventario, max_dias=RETENCAO_MAX_DIAS, orcamento_bytes=ORCAMENTO_DISCO_BYTES,
+                 politica=POLITICA_RETENCAO):
+        if politica not in ("antigos", "lru"):
+            raise ValueError(f"Política de retenção desconhecida: {politica}")
+        self.inventario = inventario
+        self.max_dias = max_dias
+        self.orcamento_bytes = orcamento_bytes
+        self.politica = politica
+
+    @staticmethod
+    def _last_access(registro):
+        """
+        Acesso mais recente a algum arquivo do produto. O atime da pasta .SAFE não muda quando os arquivos são
+        lidos, então cada arquivo é consultado; o mtime cobre volumes montados com noatime.
+        """
+        ultimo = 0
+        for pasta, _, arquivos in os.walk(registro.caminho):
+            for nome_arquivo in arquivos:
+                try:
+                    estado = os.stat(os.path.join(pasta, nome_arquivo))
+                except OSError:
+                    continue
+                ultimo = max(ultimo, estado.st_atime, estado.st_mtime)
+        return ultimo
+
+    def _eviction_order(self, registros):
+        if self.politica == "lru":
+            return sorted(registros, key=self._last_access)
+        return sorted(registros, key=lambda registro: (registro.data_sensor or "", registro.baixado_em))
+
+    def _evict(self, registro):
+        """Tira o produto do inventário e do disco. O rename é atômico; o rmtree, que pode falhar no meio, fica depois."""
+        lixeira = registro.caminho + SUFIXO_REMOCAO
+
+        def renomear():
+            if os.path.isdir(registro.caminho):
+                os.replace(registro.caminho, lixeira)
+
+        self.inventario.remove(registro.produto, renomear)
+        shutil.rmtree(lixeira, ignore_errors=True)
+
+    def _purge_leftovers(self, diretorio_base):
+        """Apaga pastas de remoções interrompidas em execuções anteriores."""
+        for caminho in glob.glob(os.path.join(diretorio_base, "*", "*", "*", "*.SAFE" + SUFIXO_REMOCAO)):
+            shutil.rmtree(caminho, ignore_errors=True)
+
+    def run(self, diretorio_base=DIRETORIO_OUTPUT_BASE):
+        """Aplica idade máxima e orçamento. Retorna (produtos removidos, bytes liberados)."""
+        self._purge_leftovers(diretorio_base)
+        if not self.max_dias and not self.orcamento_bytes:
+            return 0, 0
+
+        registros = self._eviction_order(self.inventario.records())
+        remover = []
+        if self.max_dias:
+            limite = (datetime.now() - timedelta(days=self.max_dias)).strftime('%Y%m%d')
+            remover = [registro for registro in registros if registro.data_sensor and registro.data_sensor < limite]
+        if self.orcamento_bytes:
+            restantes = [registro for registro in registros if registro not in remover]
+            excedente = sum(registro.bytes for registro in restantes) - self.orcamento_bytes
+            for registro in restantes:
+                if excedente <= 0:
+                    break
+                remover.append(registro)
+                excedente -= registro.bytes
+
+        removidos, liberados = 0, 0
+        for registro in remover:
+            try:
+                self._evict(registro)
+            except OSError as e:
+                logging.error(f"❌ Falha ao remover {registro.caminho}: {e}")
+                continue
+            removidos += 1
+            liberados += registro.bytes
+            logging.info(f"🧹 Removido pela retenção: {registro.produto} ({format_bytes(registro.bytes)})")
+        if remover:
+            logging.info(f"🧹 Retenção: {removidos} produto(s) removido(s), {format_bytes(liberados)} liberados.")
+        return removidos, liberados
+
+# --- Planejamento de Downloads ---
+MARGEM_ESPACO_LIVRE = 1024 ** 3 # Bytes que sempre ficam livres no volume de saída
+
+# Arquivos de um produto e quantos bytes ainda precisam ir para o disco
+DownloadPlan = namedtuple("DownloadPlan", ["uri", "objetos", "total_bytes", "bytes_pendentes"])
+
+def format_duration(segundos):
+    """Formata uma duração em segundos como 1h02m, 3m20s ou 45s."""
+    segundos = int(round(segundos))
+    if segundos >= 3600:
+        return f"{segundos // 3600}h{segundos % 3600 // 60:02d}m"
+    if segundos >= 60:
+        return f"{segundos // 60}m{segundos % 60:02d}s"
+    return f"{segundos}s"
+
+class DiskSpaceBudget:
+    """
+    Admite downloads enquanto couberem no espaço livre do volume de saída, descontando a margem
+    e o que já foi reservado para downloads admitidos e ainda não concluídos. Um produto que não
+    cabe é adiado, em vez de encher o disco no meio e deixar produtos pela metade.
+    """
+
+    def __init__(self, diretorio=DIRETORIO_OUTPUT_BASE, margem=MARGEM_ESPACO_LIVRE):
+        self.diretorio = diretorio
+        self.margem = margem
+        self.reservado = 0
+        self.lock = threading.Lock()
+
+    def free_space(self):
+        # Antes do primeiro download a pasta de saída pode não existir; mede o volume da pasta mais próxima
+        diretorio = os.path.abspath(self.diretorio)
+        while not os.path.isdir(diretorio):
+            diretorio = os.path.dirname(diretorio)
+        return shutil.disk_usage(diretorio).free
+
+    def reserve(self, quantidade):
+        """Reserva 'quantidade' bytes se couberem. Retorna True se o download foi admitido."""
+        with self.lock:
+            # O disco livre já diminui durante os downloads em andamento, então a conta é conservadora
+            if self.reservado + quantidade > self.free_space() - self.margem:
+                return False
+            self.reservado += quantidade
+            return True
+
+    def release(self, quantidade):
+        with self.lock:
+            self.reservado = max(0, self.reservado - quantidade)
+
+# --- Plano de Downloads (--plan) ---
+# Decisão tomada para cada produto do plano
+DECISAO_BAIXAR = "baixar"
+DECISAO_JA_EXISTE = "ja_existe"
+DECISAO_REJEITADO = "rejeitado"
+DECISAO_SEM_METADADOS = "sem_metadados"
+DECISAO_ADIADO = "adiado"
+DECISAO_ERRO = "erro"
+
+PlanEntry = namedtuple("PlanEntry", ["produto", "tile", "data_sensor", "uri", "destino", "cobertura_nuvens",
+                                     "decisao", "motivo", "bytes_estimados"])
+
+def write_plan(entradas, caminho, datas):
+    """
+    Grava o plano em JSON ou, se o arquivo terminar em .csv, em CSV. O arquivo é escrito ao lado e
+    renomeado no fim, para que quem o consome nunca leia um plano pela metade.
+    """
+    entradas = sorted(entradas, key=lambda entrada: (entrada.tile or "", entrada.data_sensor or "", entrada.produto))
+    temporario = caminho + SUFIXO_ARQUIVO_PARCIAL
+    with open(temporario, "w", encoding="utf-8", newline="") as arquivo:
+        if caminho.lower().endswith(".csv"):
+            escritor = csv.writer(arquivo)
+            escritor.writerow(PlanEntry._fields)
+            escritor.writerows(entradas)
+        else:
+            json.dump({"gerado_em": datetime.now().isoformat(timespec='seconds'),
+                       "datas": [min(datas), max(datas)],
+                       "limite_cobertura_nuvens": LIMITE_COBERTURA_NUVENS,
+                       "produtos": [entrada._asdict() for entrada in entradas]},
+                      arquivo, ensure_ascii=False, indent=2)
+    os.replace(temporario, caminho)
+    a_baixar = [entrada for entrada in entradas if entrada.decisao == DECISAO_BAIXAR]
+    logging.info(f"🗒️ Plano gravado em '{caminho}': {len(entradas)} produto(s), {len(a_baixar)} a baixar "
+                 f"({format_bytes(sum(entrada.bytes_estimados or 0 for entrada in a_baixar))}).")
+
+# --- Pipeline de Processamento ---
+LIMITE_COBERTURA_NUVENS = 30.0 # Porcentagem máxima de nuvens para baixar um produto
+
+# Concorrência de cada estágio (a listagem usa MAX_WORKERS_LISTAGEM):
+MAX_WORKERS_METADADOS = 4 # Lotes de MTD_MSIL2A.xml verificados ao mesmo tempo
+MAX_WORKERS_DOWNLOAD = 3 # Produtos baixados ao mesmo tempo, dividindo LIMITE_BANDA_BYTES_S
+
+# Capacidade das filas entre os estágios; um estágio lento segura os anteriores em vez de acumular memória
+TAMANHO_FILA_CANDIDATOS = 200
+TAMANHO_FILA_DOWNLOADS = 20
+
+# Tempo (s) que um verificador espera por mais candidatos antes de enviar um lote incompleto
+ESPERA_LOTE_METADADOS = 0.5
+
+# Produto que passou pelo filtro de datas e ainda não existe localmente
+# ('cobertura_nuvens' e 'total_bytes' vêm preenchidos quando o candidato sai do catálogo)
+Candidate = namedtuple("Candidate", ["codigo", "produto", "caminho_local_base", "cobertura_nuvens", "total_bytes"],
+                       defaults=(None, None))
+
+# Marca o fim do trabalho em uma fila do pipeline
+_FIM_ESTAGIO = object()
+
+# Vezes que um produto encerrado pelo watchdog volta para o fim da fila na mesma execução
+MAX_REENFILEIRAMENTOS = 2
+
+class DownloadPipeline:
+    """
+    Executa listagem → filtro de datas → verificação de nuvens → download como estágios
+    independentes ligados por filas limitadas. Um download demorado não impede que os
+    candidatos dos outros tiles continuem sendo verificados. Com 'planejar', o último estágio só
+    estima o tamanho dos produtos aprovados e cada decisão vai para self.plano, sem baixar nada.
+    """
+
+    def __init__(self, backend, datas, metadata_cache=None, codigos_tiles=None,
+                 max_workers_listagem=MAX_WORKERS_LISTAGEM, max_workers_metadados=MAX_WORKERS_METADADOS,
+                 max_workers_download=MAX_WORKERS_DOWNLOAD, tamanho_lote=TAMANHO_LOTE_METADADOS,
+                 limite_banda=LIMITE_BANDA_BYTES_S, bandas=BANDAS_SELECIONADAS, inventario=None, espaco=None,
+                 planejar=False, watchdog=None, falhas=None, catalogo=None, marcas=None, cache_listagem=None,
+                 filtros=None):
+        self.backend = backend
+        self.datas = datas
+        self.metadata_cache = metadata_cache
+        self.codigos_tiles = codigos if codigos_tiles is None else codigos_tiles
+        self.max_workers_listagem = max(1, max_workers_listagem)
+        self.max_workers_metadados = max(1, max_workers_metadados)
+        self.max_workers_download = max(1, max_workers_download)
+        self.tamanho_lote = max(1, tamanho_lote)
+        self.bandas = bandas
+        self.inventario = inventario
+        self.fila_candidatos = queue.Queue(maxsize=TAMANHO_FILA_CANDIDATOS)
+        self.fila_downloads = queue.Queue(maxsize=TAMANHO_FILA_DOWNLOADS)
+        self.limitador = BandwidthLimiter(limite_banda)
+        self.estatisticas = TransferStats()
+        self.espaco = DiskSpaceBudget() if espaco is None else espaco
+        self.limite_banda = limite_banda
+        self.bytes_em_andamento = 0 # Bytes admitidos que ainda não terminaram de baixar
+        self.plano = [] if planejar else None
+        self.watchdog = TransferWatchdog() if watchdog is None else watchdog
+        # Produtos encerrados pelo watchdog; sem limite de tamanho para que um baixador nunca bloqueie ao devolvê-los
+        self.fila_reenvio = queue.Queue()
+        self.reenfileiramentos = {}
+        self.falhas = falhas
+        self.catalogo = catalogo
+        self.marcas = marcas
+        self.cache_listagem = cache_listagem
+        self.filtros = filtros or {} # Critérios de ProductTable.filter além das datas (missões, órbitas, baseline)
+        self._tiles_listados = set() # Tiles cuja listagem terminou sem erro nesta execução
+        self._enfileirados = set() # Produtos já enviados aos verificadores, para a retomada não duplicar a listagem
+        self._listagens_pendentes = set() # Tiles cuja retomada falhou; continuam na fila mesmo se a janela atual listar
+        self._lock = threading.Lock()
+        self.contadores = {"listados": 0, "candidatos": 0, "aprovados": 0, "rejeitados": 0,
+                           "sem_metadados": 0, "adiados": 0, "baixados": 0, "travados": 0, "falhas": 0,
+                           "retomados": 0, "ja_vistos": 0}
+
+    def _contar(self, chave, quantidade=1):
+        with self._lock:
+            self.contadores[chave] += quantidade
+
+    def _record(self, codigo, produto, caminho_local_base, decisao, motivo, cobertura_nuvens=None, bytes_estimados=None):
+        """Acrescenta uma decisão ao plano, quando a execução é só de planejamento."""
+        if self.plano is None:
+            return
+        entrada = PlanEntry(produto.nome, "".join(codigo), produto.data_sensor, produto.uri,
+                            os.path.join(caminho_local_base, produto.nome), cobertura_nuvens, decisao, motivo, bytes_estimados)
+        with self._lock:
+            self.plano.append(entrada)
+
+    def _record_failure(self, tipo, uri, codigo, erro, datas=()):
+        """Guarda a falha na fila persistente (no modo de planejamento nada é registrado)."""
+        if self.falhas is not None and self.plano is None:
+            self.falhas.record(tipo, uri, codigo, erro, datas)
+
+    def _resolve_failure(self, tipo, uri):
+        if self.falhas is not None and self.plano is None:
+            self.falhas.resolve(tipo, uri)
+
+    def _listing_finished(self, codigo, erro):
+        uri = build_tile_uri(codigo)
+        if erro is None:
+            with self._lock:
+                self._tiles_listados.add("".join(codigo))
+            if uri not in self._listagens_pendentes:
+                self._resolve_failure(FALHA_LISTAGEM, uri)
+        else:
+            self._record_failure(FALHA_LISTAGEM, uri, codigo, erro, self.datas)
+
+    # --- Estágio 1 e 2: listagem e filtro de datas ---
+    def _resume_failures(self):
+        """
+        Retoma a fila de falhas de execuções anteriores antes do trabalho novo. Produtos voltam direto
+        para a verificação de nuvens (o download só precisa do resultado, que normalmente já está no cache),
+        mesmo que já tenham saído da janela de datas; tiles voltam a ser listados nas datas que falharam.
+        """
+        for entrada in self.falhas.pending():
+            self._contar("retomados")
+            logging.info(f"♻️ Retomando {entrada.tipo} de '{entrada.uri}' (tentativa {entrada.tentativas + 1} de "
+                         f"{self.falhas.max_tentativas}). Último erro: {entrada.ultimo_erro}")
+            if entrada.tipo == FALHA_LISTAGEM:
+                datas = set(entrada.datas) - set(self.datas) # As da janela atual já serão listadas a seguir
+                if not datas:
+                    continue
+                try:
+                    produtos = list(self.backend.iter_safe_folders(entrada.uri, datas))
+                except Exception as e:
+                    logging.error(f"🔥 Erro ao listar o código {entrada.codigo}: {e}")
+                    self._record_failure(FALHA_LISTAGEM, entrada.uri, entrada.codigo, e, datas)
+                    self._listagens_pendentes.add(entrada.uri)
                     continue
-                
-                data_da_pasta = match.group(1)
-
-                if data_da_pasta in datas_recentes:
-                    logging.info(f"\n--- ✅ Pasta Encontrada! ---\nData: {data_da_pasta}\nCaminho: {pasta_uri}\n--------------------------")
-                    
-                    caminho_local_base = os.path.join(DIRETORIO_OUTPUT_BASE, codigo[0], codigo[1], codigo[2])
-                    os.makedirs(caminho_local_base, exist_ok=True)
-                    caminho_local_final = os.path.join(caminho_local_base, nome_pasta)
-                    if os.path.exists(caminho_local_final):
-                        logging.info(f"🗄️   Diretório local já existe, pulando download: {caminho_local_final}")
+                # Só sai da fila quando a janela atual também for listada com sucesso
+                for produto in produtos:
+                    self._contar("listados")
+                    self._consider(entrada.codigo, produto, datas)
+            else:
+                produto = make_safe_product(entrada.uri)
+                self._consider(entrada.codigo, produto, {produto.data_sensor})
+
+    def _consider(self, codigo, produto, datas=None, cobertura_nuvens=None, total_bytes=None):
+        """
+        Envia o produto à verificação de nuvens se ele estiver nas datas pedidas e ainda não existir localmente.
+        Uma 'cobertura_nuvens' já conhecida (do catálogo) dispensa a leitura do MTD_MSIL2A.xml, e um 'total_bytes'
+        conhecido dispensa a listagem do produto no modo de planejamento.
+        """
+        datas = self.datas if datas is None else datas
+        try:
+            if not produto.data_sensor or produto.data_sensor not in datas:
+                return
+            if produto.nome in self._enfileirados:
+                return
+            logging.info(f"\n--- ✅ Pasta Encontrada! ---\nCódigo: {codigo}\nData: {produto.data_sensor}\nCaminho: {produto.uri}\n--------------------------")
+
+            caminho_local_base = os.path.join(DIRETORIO_OUTPUT_BASE, codigo[0], codigo[1], codigo[2])
+            caminho_local_final = os.path.join(caminho_local_base, produto.nome)
+            # Com inventário a checagem é em memória; sem ele, um stat no disco
+            if self.inventario is not None:
+                ja_existe = produto.nome in self.inventario
+            else:
+                ja_existe = os.path.exists(caminho_local_final)
+            if ja_existe:
+                logging.info(f"🗄️   Produto já existe localmente, pulando download: {caminho_local_final}")
+                self._record(codigo, produto, caminho_local_base, DECISAO_JA_EXISTE, "produto já está no disco")
+                self._resolve_failure(FALHA_METADADOS, produto.uri)
+                self._resolve_failure(FALHA_DOWNLOAD, produto.uri)
+                return
+            if self.plano is None:
+                os.makedirs(caminho_local_base, exist_ok=True)
+            self._enfileirados.add(produto.nome)
+            self._contar("candidatos")
+            self.fila_candidatos.put(Candidate(codigo, produto, caminho_local_base, cobertura_nuvens, total_bytes))
+        except Exception as e:
+            logging.error(f"🔥 Erro ao processar a pasta {produto.uri}: {e}")
+
+    def _filter_stage(self):
+        try:
+            if self.falhas is not None:
+                self._resume_failures()
+            if self.catalogo is not None:
+                # Candidatos e nuvens vêm de uma consulta local, sem listar o bucket
+                candidatos = list(self.catalogo.candidates(self.codigos_tiles, self.datas))
+                permitidos = None
+                if self.filtros:
+                    permitidos = set(ProductTable.from_uris([produto.uri for _, produto, _, _ in candidatos])
+                                     .filter(**self.filtros).uris)
+                for codigo, produto, cobertura_nuvens, total_bytes in candidatos:
+                    self._contar("listados")
+                    if permitidos is not None and produto.uri not in permitidos:
                         continue
-                    
-                    # --- VERIFICAÇÃO DE COBERTURA DE NUVENS ---
-                    cloud_cover_percentage = get_cloud_cover(pasta_uri)
-                    
-                    # Se a verificação falhou (retornou None), pula para a próxima pasta
-                    if cloud_cover_percentage is None:
-                        logging.warning(f"⚠️ Não foi possível verificar a cobertura de nuvens para {nome_pasta}. Pulando.")
+                    self._consider(codigo, produto, cobertura_nuvens=cobertura_nuvens, total_bytes=total_bytes)
+                return
+            datas_por_tile = None
+            if self.marcas is not None:
+                datas_por_tile = {"".join(codigo): self.marcas.dates_to_list("".join(codigo), self.datas)
+                                  for codigo in self.codigos_tiles}
+                if self.marcas.reconciliando:
+                    logging.info(f"🔭 Listagem completa (reconciliação) de {len(self.marcas.reconciliando)} tile(s).")
+            for codigo, produto in stream_tiles_concurrently(self.codigos_tiles, self.max_workers_listagem,
+                                                             self.datas, self.backend,
+                                                             ao_terminar=self._listing_finished,
+                                                             datas_por_tile=datas_por_tile,
+                                                             cache_listagem=self.cache_listagem,
+                                                             filtros=self.filtros):
+                self._contar("listados")
+                if self.marcas is not None and produto.data_sensor in self.datas:
+                    tile = "".join(codigo)
+                    if not self.marcas.is_new(tile, produto):
+                        self._contar("ja_vistos")
                         continue
+                    self.marcas.advance(tile, produto)
+                self._consider(codigo, produto)
+        finally:
+            for _ in range(self.max_workers_metadados):
+                self.fila_candidatos.put(_FIM_ESTAGIO)
+
+    # --- Estágio 3: verificação de cobertura de nuvens ---
+    def _take_batch(self):
+        """Retira até 'tamanho_lote' candidatos da fila. Retorna (lote, fim_da_fila)."""
+        item = self.fila_candidatos.get()
+        if item is _FIM_ESTAGIO:
+            return [], True
+        lote = [item]
+        while len(lote) < self.tamanho_lote:
+            try:
+                item = self.fila_candidatos.get(timeout=ESPERA_LOTE_METADADOS)
+            except queue.Empty:
+                break
+            if item is _FIM_ESTAGIO:
+                return lote, True
+            lote.append(item)
+        return lote, False
+
+    def _metadata_stage(self):
+        fim = False
+        while not fim:
+            lote, fim = self._take_batch()
+            if not lote:
+                continue
+            a_verificar = [candidato.produto.uri for candidato in lote if candidato.cobertura_nuvens is None]
+            try:
+                coberturas = get_cloud_cover_batch(a_verificar, self.metadata_cache, self.backend) if a_verificar else {}
+            except Exception as e:
+                logging.error(f"🔥 Erro ao verificar a cobertura de nuvens de {len(a_verificar)} produto(s): {e}")
+                coberturas = {uri: e for uri in a_verificar}
+            coberturas.update({candidato.produto.uri: candidato.cobertura_nuvens for candidato in lote
+                               if candidato.cobertura_nuvens is not None})
+            for candidato in lote:
+                self._decide(candidato, coberturas.get(candidato.produto.uri))
+
+    def _decide(self, candidato, cloud_cover_percentage):
+        nome_pasta = candidato.produto.nome
+        # Se a verificação falhou (retornou None), pula para a próxima pasta
+        if cloud_cover_percentage is None or isinstance(cloud_cover_percentage, Exception):
+            self._contar("sem_metadados")
+            self._record_failure(FALHA_METADADOS, candidato.produto.uri, candidato.codigo,
+                                 cloud_cover_percentage or f"{METADATA_FILENAME} ilegível ou sem cobertura de nuvens; detalhes no log")
+            self._record(candidato.codigo, candidato.produto, candidato.caminho_local_base, DECISAO_SEM_METADADOS,
+                         f"{METADATA_FILENAME} ilegível ou sem cobertura de nuvens")
+            logging.warning(f"⚠️ Não foi possível verificar a cobertura de nuvens para {nome_pasta}. Pulando.")
+            return
+
+        self._resolve_failure(FALHA_METADADOS, candidato.produto.uri)
+        # Verifica se a cobertura está dentro do limite
+        if cloud_cover_percentage <= LIMITE_COBERTURA_NUVENS:
+            self._contar("aprovados")
+            logging.info(f"✔️ Cobertura de nuvens de {nome_pasta} ({cloud_cover_percentage:.2f}%) está abaixo do limite de {LIMITE_COBERTURA_NUVENS:.0f}%. Na fila para download.")
+            self.fila_downloads.put(candidato._replace(cobertura_nuvens=cloud_cover_percentage))
+        else:
+            self._contar("rejeitados")
+            self._record(candidato.codigo, candidato.produto, candidato.caminho_local_base, DECISAO_REJEITADO,
+                         f"cobertura de nuvens acima de {LIMITE_COBERTURA_NUVENS:.0f}%", cloud_cover_percentage)
+            logging.info(f"➡️ Cobertura de nuvens ({cloud_cover_percentage:.2f}%) excede o limite de {LIMITE_COBERTURA_NUVENS:.0f}%. Download de {nome_pasta} ignorado.")
+
+    # --- Estágio 4: planejamento e download ---
+    def _estimate_eta(self, quantidade):
+        """Tempo estimado para 'quantidade' bytes, pela vazão medida ou, antes da primeira medição, pelo limite de banda."""
+        vazao = self.estatisticas.aggregate_rate() or self.limite_banda
+        return format_duration(quantidade / vazao) if vazao else "desconhecido"
+
+    def _admit(self, candidato):
+        """Estima o tamanho do produto e reserva espaço em disco. Retorna o DownloadPlan, ou None se adiado."""
+        plano = self.backend.plan_download(candidato.produto.uri, candidato.caminho_local_base, self.bandas)
+        if not self.espaco.reserve(plano.bytes_pendentes):
+            self._contar("adiados")
+            logging.warning(f"💾 {candidato.produto.nome} ({format_bytes(plano.bytes_pendentes)}) não cabe no espaço livre "
+                            f"de '{self.espaco.diretorio}' ({format_bytes(self.espaco.free_space())}, margem de "
+                            f"{format_bytes(self.espaco.margem)}). Adiado para a próxima execução.")
+            # Vai para a fila de falhas: a marca da listagem já passou por ele
+            self._record_failure(FALHA_DOWNLOAD, candidato.produto.uri, candidato.codigo, "sem espaço livre no volume de saída")
+            return None
+        with self._lock:
+            self.bytes_em_andamento += plano.bytes_pendentes
+            em_andamento = self.bytes_em_andamento
+        logging.info(f"📐 {candidato.produto.nome}: {format_bytes(plano.total_bytes)} ({format_bytes(plano.bytes_pendentes)} a baixar). "
+                     f"Em andamento: {format_bytes(em_andamento)}, ETA ~{self._estimate_eta(em_andamento)}")
+        return plano
+
+    def _next_download(self, fim_recebido):
+        """
+        Próximo produto a baixar: os devolvidos pelo watchdog primeiro. Cada worker retira um único _FIM_ESTAGIO
+        da fila principal; 'fim_recebido' diz se ele já o retirou, para não esperar (nem tomar o de outro worker)
+        depois disso. Retorna (candidato, fim_recebido), com _FIM_ESTAGIO como candidato quando tudo acabou.
+        """
+        try:
+            return self.fila_reenvio.get_nowait(), fim_recebido
+        except queue.Empty:
+            pass
+        if fim_recebido:
+            return _FIM_ESTAGIO, True
+        candidato = self.fila_downloads.get()
+        if candidato is not _FIM_ESTAGIO:
+            return candidato, False
+        # Fim da fila principal: ainda é preciso esvaziar a de reenvio
+        try:
+            return self.fila_reenvio.get_nowait(), True
+        except queue.Empty:
+            return _FIM_ESTAGIO, True
+
+    def _download_stage(self):
+        fim_recebido = False
+        while True:
+            candidato, fim_recebido = self._next_download(fim_recebido)
+            if candidato is _FIM_ESTAGIO:
+                return
+            try:
+                plano = self._admit(candidato)
+            except Exception as e:
+                logging.error(f"🔥 Erro ao estimar o tamanho de {candidato.produto.uri}: {e}")
+                self._contar("falhas")
+                self._record_failure(FALHA_DOWNLOAD, candidato.produto.uri, candidato.codigo, e)
+                continue
+            if plano is None:
+                continue
+            inicio = self.estatisticas.start()
+            # O progresso é medido pelo que chega ao staging, igual para a API e para o gcloud
+            staging = os.path.join(candidato.caminho_local_base, candidato.produto.nome) + SUFIXO_STAGING
+            with self.watchdog.watch(candidato.produto.nome, lambda: get_dir_size(staging)) as transferencia:
+                try:
+                    sucesso = self.backend.download_folder(candidato.produto.uri, candidato.caminho_local_base,
+                                                           self.limitador, self.bandas, self.inventario, plano,
+                                                           transferencia)
+                except Exception as e:
+                    logging.error(f"🔥 Erro ao processar a pasta {candidato.produto.uri}: {e}")
+                    sucesso = False
+                finally:
+                    self.espaco.release(plano.bytes_pendentes)
+                    with self._lock:
+                        self.bytes_em_andamento -= plano.bytes_pendentes
+            if not sucesso and transferencia.travada:
+                self._requeue(candidato)
+                continue
+            self._contar("baixados" if sucesso else "falhas")
+            if sucesso:
+                self._resolve_failure(FALHA_DOWNLOAD, candidato.produto.uri)
+                caminho_local_final = os.path.join(candidato.caminho_local_base, candidato.produto.nome)
+                self.estatisticas.finish(candidato.produto.nome, get_dir_size(caminho_local_final), inicio)
+            else:
+                self._record_failure(FALHA_DOWNLOAD, candidato.produto.uri, candidato.codigo,
+                                     transferencia.erro or "falha no download; detalhes no log")
+
+    def _requeue(self, candidato):
+        """Devolve ao fim da fila um produto encerrado pelo watchdog; o staging permite retomar de onde parou."""
+        self._contar("travados")
+        nome_pasta = candidato.produto.nome
+        with self._lock:
+            self.reenfileiramentos[nome_pasta] = self.reenfileiramentos.get(nome_pasta, 0) + 1
+            vezes = self.reenfileiramentos[nome_pasta]
+        if vezes > MAX_REENFILEIRAMENTOS:
+            logging.error(f"🔥 {nome_pasta} travou {vezes} vez(es); desistindo nesta execução.")
+            self.watchdog.record(nome_pasta, "desistencia", f"travou {vezes} vez(es)")
+            self._contar("falhas")
+            self._record_failure(FALHA_DOWNLOAD, candidato.produto.uri, candidato.codigo, f"transferência travou {vezes} vez(es)")
+            return
+        logging.info(f"🔁 {nome_pasta} voltou para a fila de downloads ({vezes}/{MAX_REENFILEIRAMENTOS}).")
+        self.watchdog.record(nome_pasta, "reenfileirado", f"{vezes}/{MAX_REENFILEIRAMENTOS}")
+        self.fila_reenvio.put(candidato)
+
+    def _estimate_plan_bytes(self, candidato):
+        """
+        Bytes que o produto ocuparia, ou None se não houver nada a baixar. O tamanho do catálogo evita listar
+        o produto quando ele vale: produto inteiro (sem seleção de bandas) e sem staging de uma execução anterior.
+        """
+        staging = os.path.join(candidato.caminho_local_base, candidato.produto.nome) + SUFIXO_STAGING
+        if candidato.total_bytes and not self.bandas and not os.path.isdir(staging):
+            return candidato.total_bytes
+        plano = self.backend.plan_download(candidato.produto.uri, candidato.caminho_local_base, self.bandas)
+        return plano.bytes_pendentes if plano.objetos else None
+
+    def _plan_stage(self):
+        """Substitui o download no modo de planejamento: estima o tamanho e decide se o produto caberia no disco."""
+        while True:
+            candidato = self.fila_downloads.get()
+            if candidato is _FIM_ESTAGIO:
+                return
+            registrar = lambda *args: self._record(candidato.codigo, candidato.produto, candidato.caminho_local_base,
+                                                   *args, candidato.cobertura_nuvens, bytes_estimados)
+            bytes_estimados = None
+            try:
+                bytes_estimados = self._estimate_plan_bytes(candidato)
+            except Exception as e:
+                logging.error(f"🔥 Erro ao estimar o tamanho de {candidato.produto.uri}: {e}")
+                self._contar("falhas")
+                registrar(DECISAO_ERRO, f"falha ao listar o produto: {e}")
+                continue
+            if bytes_estimados is None:
+                # O download falharia do mesmo jeito ("nenhum arquivo a baixar")
+                self._contar("falhas")
+                registrar(DECISAO_ERRO, "nenhum arquivo a baixar no produto")
+                continue
+            # As reservas não são liberadas: o plano inteiro precisa caber no disco
+            if self.espaco.reserve(bytes_estimados):
+                registrar(DECISAO_BAIXAR, f"cobertura de nuvens até {LIMITE_COBERTURA_NUVENS:.0f}%")
+            else:
+                self._contar("adiados")
+                registrar(DECISAO_ADIADO, "não cabe no espaço livre do volume de saída")
+
+    def run(self):
+        """Executa todos os estágios até o fim e retorna os contadores da execução."""
+        filtro = threading.Thread(target=self._filter_stage, name="filtro")
+        verificadores = [threading.Thread(target=self._metadata_stage, name=f"metadados-{n}")
+                         for n in range(self.max_workers_metadados)]
+        estagio_final = self._download_stage if self.plano is None else self._plan_stage
+        baixadores = [threading.Thread(target=estagio_final, name=f"download-{n}")
+                      for n in range(self.max_workers_download)]
+        for thread in [filtro] + verificadores + baixadores:
+            thread.start()
+
+        filtro.join()
+        for thread in verificadores:
+            thread.join()
+        # Só depois que todas as verificações terminaram é que não há mais downloads a enfileirar
+        for _ in baixadores:
+            self.fila_downloads.put(_FIM_ESTAGIO)
+        for thread in baixadores:
+            thread.join()
+
+        # As marcas só avançam depois que tudo o que foi listado terminou ou entrou na fila de falhas
+        if self.marcas is not None and self.plano is None and self.catalogo is None:
+            self.marcas.save(self._tiles_listados)
+        self.estatisticas.log_summary()
+        logging.info("📊 Resumo: " + ", ".join(f"{chave}={valor}" for chave, valor in self.contadores.items()))
+        return dict(self.contadores)
+
+# --- Backfill Histórico ---
+ESPERA_ENTRE_UNIDADES_S = 30 # Pausa entre duas unidades do backfill, para não disputar o bucket e a banda com as execuções diárias
+
+# Estados de uma unidade de trabalho do backfill
+UNIDADE_PENDENTE = "pendente"
+UNIDADE_CONCLUIDA = "concluida"
+UNIDADE_ABANDONADA = "abandonada" # Falhou em 'max_tentativas' execuções; não é mais tentada
+
+# Unidade de trabalho do backfill: um tile em um mês, recortado pela janela pedida (datas YYYYMMDD inclusivas)
+BackfillUnit = namedtuple("BackfillUnit", ["tile", "inicio", "fim"])
+
+class BackfillRunner:
+    """
+    Baixa uma janela histórica dividida em unidades de trabalho (um tile × um mês), processadas uma de cada vez
+    por um DownloadPipeline e separadas por uma pausa. Ao fim de cada unidade o resultado é gravado no banco:
+    um backfill interrompido recomeça da primeira unidade pendente, e uma unidade que terminou com listagem,
+    verificação ou download incompletos é repetida nas execuções seguintes, até 'max_tentativas'.
+    """
 
-                    # Verifica se a cobertura está dentro do limite de 30%
-                    if cloud_cover_percentage <= 30.0:
-                        logging.info(f"✔️ Cobertura de nuvens ({cloud_cover_percentage:.2f}%) está abaixo do limite de 30%. Baixando.")
-                        # Faz o download da pasta:
-                        download_folder(pasta_uri, caminho_local_base)
-                    else:
-                        logging.info(f"➡️ Cobertura de nuvens ({cloud_cover_percentage:.2f}%) excede o limite de 30%. Download de {nome_pasta} ignorado.")
+    def __init__(self, banco, backend, inicio, fim, codigos_tiles=None, espera=ESPERA_ENTRE_UNIDADES_S,
+                 max_tentativas=MAX_TENTATIVAS_FILA, **opcoes_pipeline):
+        self.banco = banco
+        self.backend = backend
+        self.inicio = inicio
+        self.fim = fim
+        self.codigos_tiles = codigos if codigos_tiles is None else codigos_tiles
+        self.espera = espera
+        self.max_tentativas = max_tentativas
+        self.opcoes_pipeline = opcoes_pipeline
+        self.banco.execute(
+            """CREATE TABLE IF NOT EXISTS backfill_unidades (
+                   tile TEXT NOT NULL,
+                   inicio TEXT NOT NULL,
+                   fim TEXT NOT NULL,
+                   estado TEXT NOT NULL,
+                   tentativas INTEGER NOT NULL,
+                   listados INTEGER,
+                   baixados INTEGER,
+                   ultimo_erro TEXT,
+                   atualizado_em TEXT NOT NULL,
+                   PRIMARY KEY (tile, inicio, fim))""")
 
+    def plan_units(self):
+        """Divide a janela em unidades tile × mês, do mês mais antigo para o mais recente."""
+        unidades = []
+        mes = datetime.strptime(self.inicio[:6] + "01", '%Y%m%d')
+        while mes.strftime('%Y%m') <= self.fim[:6]:
+            proximo_mes = (mes + timedelta(days=32)).replace(day=1)
+            inicio = max(self.inicio, mes.strftime('%Y%m%d'))
+            fim = min(self.fim, (proximo_mes - timedelta(days=1)).strftime('%Y%m%d'))
+            unidades.extend(BackfillUnit("".join(codigo), inicio, fim) for codigo in self.codigos_tiles)
+            mes = proximo_mes
+        return unidades
+
+    def _states(self):
+        """Retorna {BackfillUnit: (estado, tentativas)} das unidades já registradas."""
+        return {BackfillUnit(tile, inicio, fim): (estado, tentativas) for tile, inicio, fim, estado, tentativas
+                in self.banco.execute("SELECT tile, inicio, fim, estado, tentativas FROM backfill_unidades")}
+
+    def _checkpoint(self, unidade, estado, tentativas, contadores, erro):
+        self.banco.execute(
+            "INSERT OR REPLACE INTO backfill_unidades (tile, inicio, fim, estado, tentativas, listados, baixados, "
+            "ultimo_erro, atualizado_em) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (unidade.tile, unidade.inicio, unidade.fim, estado, tentativas, contadores.get("listados"),
+             contadores.get("baixados"), erro, datetime.now().isoformat(timespec='seconds')))
+
+    def _run_unit(self, unidade):
+        """Processa uma unidade. Retorna (contadores, erro), com erro=None se tudo o que foi listado foi resolvido."""
+        pipeline = DownloadPipeline(self.backend, get_date_range(unidade.inicio, unidade.fim),
+                                    codigos_tiles=[tile_code(unidade.tile)], **self.opcoes_pipeline)
+        contadores = pipeline.run()
+        if pipeline.catalogo is None and unidade.tile not in pipeline._tiles_listados:
+            return contadores, "a listagem do tile falhou"
+        pendentes = contadores["sem_metadados"] + contadores["adiados"] + contadores["falhas"]
+        if pendentes:
+            return contadores, f"{pendentes} produto(s) sem verificação de nuvens ou download"
+        return contadores, None
+
+    def run(self):
+        """Processa as unidades pendentes da janela e retorna {estado: quantidade} ao final."""
+        unidades = self.plan_units()
+        estados = self._states()
+        pendentes = [unidade for unidade in unidades if estados.get(unidade, (UNIDADE_PENDENTE, 0))[0] == UNIDADE_PENDENTE]
+        logging.info(f"🧱 Backfill de {self.inicio} a {self.fim}: {len(unidades)} unidade(s) (tile × mês), "
+                     f"{len(unidades) - len(pendentes)} já encerrada(s) em execuções anteriores, {len(pendentes)} pendente(s).")
+
+        tempo_unidades = 0.0
+        for n, unidade in enumerate(pendentes, 1):
+            tentativas = estados.get(unidade, (UNIDADE_PENDENTE, 0))[1] + 1
+            logging.info(f"🧱 Unidade {n}/{len(pendentes)}: tile {unidade.tile}, de {unidade.inicio} a {unidade.fim} "
+                         f"(tentativa {tentativas} de {self.max_tentativas}).")
+            inicio = time.monotonic()
+            try:
+                contadores, erro = self._run_unit(unidade)
             except Exception as e:
-                logging.error(f"🔥 Erro ao processar a pasta {pasta_uri}: {e}")
+                contadores, erro = {}, str(e)
+            tempo_unidades += time.monotonic() - inicio
+
+            if erro is None:
+                estado = UNIDADE_CONCLUIDA
+                logging.info(f"✅ Unidade {unidade.tile} {unidade.inicio}–{unidade.fim} concluída.")
+            elif tentativas >= self.max_tentativas:
+                estado = UNIDADE_ABANDONADA
+                logging.error(f"❌ Unidade {unidade.tile} {unidade.inicio}–{unidade.fim} abandonada após {tentativas} "
+                              f"tentativa(s): {erro}")
+            else:
+                estado = UNIDADE_PENDENTE
+                logging.warning(f"⚠️ Unidade {unidade.tile} {unidade.inicio}–{unidade.fim} incompleta ({erro}); "
+                                "será repetida na próxima execução.")
+            self._checkpoint(unidade, estado, tentativas, contadores, erro)
+
+            restantes = len(pendentes) - n
+            if restantes:
+                eta = (tempo_unidades / n + self.espera) * restantes
+                logging.info(f"⏳ {restantes} unidade(s) restante(s) nesta execução, ETA ~{format_duration(eta)}")
+                time.sleep(self.espera)
+
+        resumo = {UNIDADE_CONCLUIDA: 0, UNIDADE_PENDENTE: 0, UNIDADE_ABANDONADA: 0}
+        estados = self._states()
+        for unidade in unidades:
+            resumo[estados.get(unidade, (UNIDADE_PENDENTE, 0))[0]] += 1
+        logging.info("🧱 Backfill: " + ", ".join(f"{estado}={quantidade}" for estado, quantidade in resumo.items()))
+        return resumo
+
+# --- Script Principal ---
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Baixa produtos Sentinel-2 L2A recentes do bucket público do Google Cloud.")
+    parser.add_argument("--reconcile", action="store_true",
+                        help=f"Reconstrói o inventário a partir de uma varredura de '{DIRETORIO_OUTPUT_BASE}' e sai.")
+    parser.add_argument("--plan", metavar="ARQUIVO",
+                        help="Não baixa nada: grava em ARQUIVO (.json ou .csv) o plano com cada produto candidato, "
+                             "sua cobertura de nuvens, a decisão e o tamanho estimado.")
+    parser.add_argument("--ingest-index", nargs="?", const=INDEX_URI, metavar="FONTE",
+                        help=f"Atualiza o catálogo local a partir do índice do bucket ({INDEX_URI}) ou de uma cópia local "
+                             "dele e sai. Não relê o índice se ele não mudou desde a última ingestão.")
+    parser.add_argument("--use-catalog", action="store_true",
+                        help="Seleciona os candidatos e a cobertura de nuvens pelo catálogo local, sem listar o bucket. "
+                             "Produtos mais novos que o índice publicado não aparecem.")
+    parser.add_argument("--start-date", type=parse_date, metavar="AAAA-MM-DD",
+                        help="Início de uma janela de datas arbitrária, no lugar dos últimos 15 dias.")
+    parser.add_argument("--end-date", type=parse_date, metavar="AAAA-MM-DD",
+                        help="Fim (inclusivo) da janela iniciada por --start-date; o padrão é hoje.")
+    parser.add_argument("--tiles", metavar="TILE,TILE",
+                        help="Tiles MGRS a processar, separados por vírgula (ex.: 23KNQ,24KTA); o padrão é a lista 'codigos'.")
+    parser.add_argument("--backfill", action="store_true",
+                        help="Baixa a janela de --start-date a --end-date em unidades de tile × mês, gravando cada unidade "
+                             "concluída; ao ser interrompido, continua da primeira unidade pendente.")
+    parser.add_argument("--backfill-pause", type=float, default=ESPERA_ENTRE_UNIDADES_S, metavar="SEGUNDOS",
+                        help="Pausa entre duas unidades do backfill.")
+    parser.add_argument("--full-listing", action="store_true",
+                        help="Lista a janela inteira de todos os tiles, ignorando as marcas de listagem (reconciliação).")
+    parser.add_argument("--listing-ttl", type=int, default=TTL_CACHE_LISTAGEM_S, metavar="SEGUNDOS",
+                        help="Reaproveita a listagem de um tile feita há menos que isso, sem consultar o bucket "
+                             "(0 = sempre listar). Ignorado com --full-listing.")
+    parser.add_argument("--missions", metavar="S2A,S2B",
+                        help="Só considera produtos destas missões.")
+    parser.add_argument("--orbits", metavar="138,95",
+                        help="Só considera produtos destas órbitas relativas (o R138 do nome do produto).")
+    parser.add_argument("--min-baseline", metavar="N0510",
+                        help="Só considera produtos com baseline de processamento igual ou mais nova (ex.: N0510 ou 510).")
+    parser.add_argument("--bands", type=parse_bands, default=BANDAS_SELECIONADAS, metavar="RES:BANDA,...;...",
+                        help="Baixa só estas bandas por resolução, mais os metadados (ex.: 'R10m:B02,B03,B04,B08;R20m:SCL'). "
+                             "Sem esta opção, a pasta .SAFE é baixada inteira.")
+    parser.add_argument("--bandwidth-limit", type=int, default=LIMITE_BANDA_BYTES_S, metavar="BYTES_S",
+                        help="Limite global de banda em bytes/s, somando todos os downloads (0 = sem limite). "
+                             "Não vale durante as transferências do backend gcloud, só na média entre elas.")
+    parser.add_argument("--listing-workers", type=int, default=MAX_WORKERS_LISTAGEM,
+                        help="Tiles listados ao mesmo tempo.")
+    parser.add_argument("--metadata-workers", type=int, default=MAX_WORKERS_METADADOS,
+                        help="Lotes de MTD_MSIL2A.xml verificados ao mesmo tempo.")
+    parser.add_argument("--download-workers", type=int, default=MAX_WORKERS_DOWNLOAD,
+                        help="Produtos baixados ao mesmo tempo, dividindo o limite de banda.")
+    parser.add_argument("--max-attempts", type=int, default=MAX_TENTATIVAS_FILA,
+                        help="Execuções que tentam de novo uma listagem, verificação ou download que falhou antes de desistir.")
+    parser.add_argument("--max-age-days", type=int, default=RETENCAO_MAX_DIAS,
+                        help="Remove produtos adquiridos há mais dias que isso (0 = sem limite).")
+    parser.add_argument("--disk-budget", type=int, default=ORCAMENTO_DISCO_BYTES,
+                        help=f"Tamanho máximo em bytes de '{DIRETORIO_OUTPUT_BASE}' (0 = sem limite).")
+    parser.add_argument("--eviction-policy", choices=("antigos", "lru"), default=POLITICA_RETENCAO,
+                        help="Ordem de remoção quando o orçamento de disco é excedido.")
+    args = parser.parse_args(argv)
+    if args.end_date and not args.start_date:
+        parser.error("--end-date exige --start-date.")
+    if args.backfill and not args.start_date:
+        parser.error("--backfill exige --start-date.")
+    if args.backfill and args.plan:
+        parser.error("--backfill não pode ser combinado com --plan.")
+    if args.start_date:
+        args.end_date = args.end_date or datetime.now().strftime('%Y%m%d')
+        if args.start_date > args.end_date:
+            parser.error("--start-date é posterior a --end-date.")
+    if args.tiles:
+        tiles = [tile.strip().upper() for tile in args.tiles.split(",") if tile.strip()]
+        invalidos = [tile for tile in tiles if not re.fullmatch(r'\d{2}[A-Z]{3}', tile)]
+        if invalidos:
+            parser.error(f"tile(s) inválido(s) em --tiles: {', '.join(invalidos)}")
+        args.tiles = [tile_code(tile) for tile in tiles]
+    # Filtros de nome aplicados às listagens pela ProductTable
+    args.filtros = {}
+    if args.missions:
+        missoes = {missao.strip().upper() for missao in args.missions.split(",") if missao.strip()}
+        if not all(re.fullmatch(r'S2[A-Z]', missao) for missao in missoes):
+            parser.error(f"missão inválida em --missions: {args.missions}")
+        args.filtros["missoes"] = missoes
+    if args.orbits:
+        orbitas = [orbita.strip().upper().lstrip("R") for orbita in args.orbits.split(",") if orbita.strip()]
+        if not all(orbita.isdigit() for orbita in orbitas):
+            parser.error(f"órbita inválida em --orbits: {args.orbits}")
+        args.filtros["orbitas"] = {int(orbita) for orbita in orbitas}
+    if args.min_baseline:
+        baseline = args.min_baseline.strip().upper().lstrip("N")
+        if not baseline.isdigit():
+            parser.error(f"baseline inválida em --min-baseline: {args.min_baseline}")
+        args.filtros["baseline_minima"] = int(baseline)
+    return args
+
+def load_inventory(banco):
+    """Carrega o inventário uma vez por execução. Na primeira execução com inventário, indexa o que já está no disco."""
+    inventario = Inventory(banco)
+    if not inventario.load() and glob.glob(os.path.join(DIRETORIO_OUTPUT_BASE, "*", "*", "*", "*.SAFE")):
+        logging.info("🗂️ Inventário vazio, mas há produtos no disco. Reconciliando...")
+        inventario.reconcile()
+    logging.info(f"🗂️ Inventário carregado: {len(inventario)} produto(s) locais.")
+    return inventario
+
+def main(argv=None):
+    args = parse_args(argv)
+    banco = StateDatabase()
+    if args.reconcile:
+        Inventory(banco).reconcile()
+        banco.close()
+        return
+
+    codigos_tiles = args.tiles or codigos
+    if args.ingest_index and not args.ingest_index.startswith("gs://"):
+        # Cópia local do índice: não precisa acessar o bucket
+        Catalog(banco).refresh(None, codigos_tiles, args.ingest_index)
+        banco.close()
+        return
+
+    backend = create_backend() # Escolhe entre a API HTTP e a CLI gcloud
+    if backend is None:
+        banco.close()
+        return
+
+    if args.ingest_index:
+        Catalog(banco).refresh(backend, codigos_tiles, args.ingest_index)
+        banco.close()
+        return
+    if args.bandwidth_limit and backend.nome == "gcloud":
+        logging.warning(f"⚠️ O backend gcloud não aceita limite de banda: cada transferência roda sem limite e "
+                        f"--bandwidth-limit ({format_bytes(args.bandwidth_limit)}/s) só espaça os downloads seguintes. "
+                        f"Para um limite real, use SENTINEL_BACKEND=http.")
+    catalogo = None
+    if args.use_catalog:
+        catalogo = Catalog(banco)
+        if not len(catalogo):
+            logging.warning("⚠️ Catálogo local vazio; rode com --ingest-index primeiro. Listando o bucket.")
+            catalogo = None
+
+    # Cache persistente das coberturas de nuvens já avaliadas em execuções anteriores
+    metadata_cache = MetadataCache(banco)
+    inventario = load_inventory(banco)
+
+    # Concorrência, banda e bandas pedidas na linha de comando, iguais para todos os modos
+    opcoes_pipeline = dict(max_workers_listagem=args.listing_workers, max_workers_metadados=args.metadata_workers,
+                           max_workers_download=args.download_workers, limite_banda=args.bandwidth_limit,
+                           bandas=args.bands, filtros=args.filtros)
+    if args.bands:
+        logging.info("🎚️ Baixando só as bandas " + "; ".join(f"{resolucao}: {', '.join(nomes)}"
+                                                           for resolucao, nomes in args.bands.items()))
+
+    if args.backfill:
+        # Janela histórica em unidades tile × mês; sem retenção, marcas de listagem nem cache de listagens
+        BackfillRunner(banco, backend, args.start_date, args.end_date, codigos_tiles, args.backfill_pause,
+                       args.max_attempts, metadata_cache=metadata_cache, inventario=inventario,
+                       watchdog=TransferWatchdog(banco), catalogo=catalogo, **opcoes_pipeline).run()
+        banco.close()
+        logging.info("\n🎉 Backfill finalizado!")
+        return
+
+    if args.start_date:
+        datas_recentes = get_date_range(args.start_date, args.end_date)
+        logging.info(f"🔎 Procurando por dados de {args.start_date} a {args.end_date}")
+    else:
+        datas_recentes = get_recent_dates(15) # Usa a função para obter as datas recentes para contruir a query
+        logging.info(f"🔎 Procurando por dados dos últimos 15 dias (de {min(datas_recentes)} a {max(datas_recentes)})")
+        # Só a janela padrão descarta o cache de nuvens fora dela; uma janela arbitrária não apaga o das execuções diárias
+        metadata_cache.evict_outside(datas_recentes)
+    # Execuções próximas (ex.: vários consumidores no mesmo dia) reaproveitam as listagens dos tiles
+    cache_listagem = None
+    if args.listing_ttl > 0 and not args.full_listing:
+        cache_listagem = ListingCache(banco, args.listing_ttl)
+
+    if args.plan:
+        # Mesmas etapas de listagem e verificação, com os mesmos caches, mas sem retenção nem downloads
+        pipeline = DownloadPipeline(backend, datas_recentes, metadata_cache, codigos_tiles, inventario=inventario,
+                                    planejar=True, catalogo=catalogo, cache_listagem=cache_listagem, **opcoes_pipeline)
+        pipeline.run()
+        write_plan(pipeline.plano, args.plan, datas_recentes)
+        banco.close()
+        return
+
+    # Libera espaço antes de começar a baixar
+    idade_janela = (datetime.now() - datetime.strptime(min(datas_recentes), '%Y%m%d')).days
+    if args.max_age_days and args.max_age_days <= idade_janela:
+        logging.warning(f"⚠️ --max-age-days={args.max_age_days} é menor que a janela de busca; "
+                        "produtos removidos podem ser baixados de novo nesta execução.")
+    RetentionManager(inventario, args.max_age_days, args.disk_budget, args.eviction_policy).run()
+
+    # Listagem, filtro, verificação de nuvens e download rodam como estágios paralelos
+    # As marcas de listagem só acompanham a janela móvel; numa janela arbitrária elas pulariam os dias antigos
+    marcas = None if args.start_date else TileWatermarks(banco, reconciliar_tudo=args.full_listing)
+    DownloadPipeline(backend, datas_recentes, metadata_cache, codigos_tiles, inventario=inventario,
+                     watchdog=TransferWatchdog(banco), falhas=FailureQueue(banco, args.max_attempts),
+                     catalogo=catalogo, marcas=marcas, cache_listagem=cache_listagem, **opcoes_pipeline).run()
+    banco.close()
     logging.info("\n🎉 Script finalizado com sucesso!")
 
 # Executa o script:
@@ -0,0 +1,111 @@
+"""
+Servidor falso da API JSON do Cloud Storage, para rodar o pipeline sem rede.
+
+Serve os arquivos de um diretório local como se fossem objetos de buckets públicos: cada
+subpasta da raiz é um bucket. Implementa só o que o GcsHttpBackend usa: 'objects.list' (com
+prefix, delimiter, maxResults e pageToken), os metadados de um objeto e o download com 'alt=media'.
+Aponte o script para ele com STORAGE_EMULATOR_HOST=http://127.0.0.1:<porta>.
+"""
+
+import http.server
+import json
+import os
+import sys
+import threading
+import urllib.parse
+
+
+class FakeGcsHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Mantém as conexões abertas, como o pool do script espera
+    raiz = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, corpo, tipo="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _send_json(self, status, dados):
+        self._send(status, json.dumps(dados).encode("utf-8"))
+
+    def _object_names(self, bucket):
+        raiz_bucket = os.path.join(self.raiz, bucket)
+        nomes = []
+        for pasta, _, arquivos in os.walk(raiz_bucket):
+            for arquivo in arquivos:
+                relativo = os.path.relpath(os.path.join(pasta, arquivo), raiz_bucket)
+                nomes.append(relativo.replace(os.sep, "/"))
+        return sorted(nomes)
+
+    def _list(self, bucket, parametros):
+        prefixo = parametros.get("prefix", "")
+        delimitador = parametros.get("delimiter")
+        itens, prefixos = [], set()
+        for nome in self._object_names(bucket):
+            if not nome.startswith(prefixo):
+                continue
+            resto = nome[len(prefixo):]
+            if delimitador and delimitador in resto:
+                prefixos.add(prefixo + resto.split(delimitador)[0] + delimitador)
+            else:
+                tamanho = os.path.getsize(os.path.join(self.raiz, bucket, *nome.split("/")))
+                itens.append({"name": nome, "size": str(tamanho)})
+
+        # Prefixos e objetos dividem a mesma paginação; o token é só a posição da próxima entrada
+        entradas = [("prefixo", p) for p in sorted(prefixos)] + [("item", i) for i in itens]
+        inicio = int(parametros.get("pageToken", 0))
+        tamanho_pagina = int(parametros.get("maxResults", 1000))
+        pagina = entradas[inicio:inicio + tamanho_pagina]
+        resposta = {"prefixes": [valor for tipo, valor in pagina if tipo == "prefixo"],
+                    "items": [valor for tipo, valor in pagina if tipo == "item"]}
+        if inicio + tamanho_pagina < len(entradas):
+            resposta["nextPageToken"] = str(inicio + tamanho_pagina)
+        self._send_json(200, resposta)
+
+    def do_GET(self):
+        partes_url = urllib.parse.urlsplit(self.path)
+        parametros = dict(urllib.parse.parse_qsl(partes_url.query))
+        # /storage/v1/b/{bucket}/o[/{objeto}]
+        partes = partes_url.path.split("/")
+        if len(partes) < 6 or partes[1:4] != ["storage", "v1", "b"] or partes[5] != "o":
+            return self._send_json(404, {"error": {"code": 404, "message": "Not Found"}})
+        bucket = partes[4]
+        if len(partes) == 6:
+            return self._list(bucket, parametros)
+
+        nome = urllib.parse.unquote(partes[6])
+        caminho = os.path.join(self.raiz, bucket, *nome.split("/"))
+        if not os.path.isfile(caminho):
+            return self._send_json(404, {"error": {"code": 404, "message": f"No such object: {bucket}/{nome}"}})
+        if parametros.get("alt") == "media":
+            with open(caminho, "rb") as f:
+                return self._send(200, f.read(), "application/octet-stream")
+        info = os.stat(caminho)
+        self._send_json(200, {"name": nome, "bucket": bucket, "generation": str(info.st_mtime_ns),
+                              "size": str(info.st_size)})
+
+
+def start_server(raiz, porta=0):
+    """
+    Sobe o servidor numa thread daemon servindo 'raiz' e retorna (servidor, endpoint). Com
+    porta 0 o sistema escolhe uma livre. Encerre com servidor.shutdown().
+    """
+    handler = type("Handler", (FakeGcsHandler,), {"raiz": os.path.abspath(raiz)})
+    servidor = http.server.ThreadingHTTPServer(("127.0.0.1", porta), handler)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="fake-gcs", daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_address[1]}"
+
+
+if __name__ == "__main__":
+    # Uso: python tests/fake_gcs.py RAIZ [PORTA]
+    servidor, endpoint = start_server(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 4443)
+    print(f"Servindo {sys.argv[1]} em {endpoint}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        servidor.shutdown()
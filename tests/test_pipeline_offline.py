@@ -0,0 +1,119 @@
+"""
+Teste de fumaça do pipeline completo contra o servidor falso do Cloud Storage (tests/fake_gcs.py).
+Roda sem rede e sem gcloud: python -m unittest discover tests  (ou: python -m pytest tests)
+"""
+
+import hashlib
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+PASTA_TESTES = os.path.dirname(os.path.abspath(__file__))
+for caminho in (PASTA_TESTES, os.path.dirname(PASTA_TESTES)):
+    if caminho not in sys.path:
+        sys.path.insert(0, caminho)
+
+import fake_gcs
+
+BUCKET = "gcp-public-data-sentinel-2"
+TILE = ["23", "K", "NQ"]
+
+
+def write_product(raiz, nome, data, cobertura_nuvens):
+    """Cria no bucket falso um produto .SAFE mínimo: metadados, uma banda e o manifest com os MD5."""
+    pasta = os.path.join(raiz, BUCKET, "L2", "tiles", *TILE, nome)
+    arquivos = {
+        "MTD_MSIL2A.xml": (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<n1:Level-2A_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-2A.xsd">'
+            f'<n1:Quality_Indicators_Info><Cloud_Coverage_Assessment>{cobertura_nuvens}</Cloud_Coverage_Assessment>'
+            '</n1:Quality_Indicators_Info></n1:Level-2A_User_Product>\n').encode("utf-8"),
+        f"GRANULE/L2A_T{''.join(TILE)}/IMG_DATA/R10m/T{''.join(TILE)}_{data}T131241_B02_10m.jp2": os.urandom(4096),
+    }
+    objetos = "".join(
+        f'<dataObject ID="obj{n}"><byteStream mimeType="application/octet-stream" size="{len(conteudo)}">'
+        f'<fileLocation locatorType="URL" href="./{relativo}"/>'
+        f'<checksum checksumName="MD5">{hashlib.md5(conteudo).hexdigest()}</checksum></byteStream></dataObject>'
+        for n, (relativo, conteudo) in enumerate(arquivos.items()))
+    arquivos["manifest.safe"] = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1">'
+        f'<dataObjectSection>{objetos}</dataObjectSection></xfdu:XFDU>\n').encode("utf-8")
+    for relativo, conteudo in arquivos.items():
+        destino = os.path.join(pasta, *relativo.split("/"))
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        with open(destino, "wb") as f:
+            f.write(conteudo)
+
+
+class OfflinePipelineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cwd_original = os.getcwd()
+        cls.temporario = tempfile.mkdtemp(prefix="sentinel_ws_teste_")
+        raiz_bucket = os.path.join(cls.temporario, "bucket")
+        data = datetime.now().strftime('%Y%m%d')
+        cls.aprovado = f"S2A_MSIL2A_{data}T131241_N0511_R138_T{''.join(TILE)}_{data}T170000.SAFE"
+        cls.rejeitado = f"S2B_MSIL2A_{data}T132241_N0511_R038_T{''.join(TILE)}_{data}T171000.SAFE"
+        write_product(raiz_bucket, cls.aprovado, data, 10.0)
+        write_product(raiz_bucket, cls.rejeitado, data, 80.0)
+
+        cls.servidor, cls.endpoint = fake_gcs.start_server(raiz_bucket)
+        cls.emulador_original = os.environ.get("STORAGE_EMULATOR_HOST")
+        os.environ["STORAGE_EMULATOR_HOST"] = cls.endpoint
+
+        # O script cria logs/ e Output_GCS/ no diretório atual ao ser importado
+        execucao = os.path.join(cls.temporario, "execucao")
+        os.makedirs(execucao)
+        os.chdir(execucao)
+        if "main" in sys.modules:
+            cls.main = importlib.reload(sys.modules["main"])
+        else:
+            cls.main = importlib.import_module("main")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.servidor.shutdown()
+        cls.servidor.server_close()
+        if cls.emulador_original is None:
+            os.environ.pop("STORAGE_EMULATOR_HOST", None)
+        else:
+            os.environ["STORAGE_EMULATOR_HOST"] = cls.emulador_original
+        os.chdir(cls.cwd_original)
+        shutil.rmtree(cls.temporario, ignore_errors=True)
+
+    def test_pipeline_downloads_only_approved_product(self):
+        main = self.main
+        self.assertEqual(main.GCS_ENDPOINT, self.endpoint)
+        backend = main.GcsHttpBackend()
+        self.assertTrue(backend.probe())
+
+        banco = main.StateDatabase(os.path.join("estado", "teste.sqlite"))
+        try:
+            inventario = main.load_inventory(banco)
+            pipeline = main.DownloadPipeline(backend, main.get_recent_dates(2), main.MetadataCache(banco),
+                                             [TILE], inventario=inventario)
+            contadores = pipeline.run()
+        finally:
+            banco.close()
+
+        self.assertEqual(contadores["listados"], 2)
+        self.assertEqual(contadores["aprovados"], 1)
+        self.assertEqual(contadores["rejeitados"], 1)
+        self.assertEqual(contadores["baixados"], 1)
+        self.assertEqual(contadores["falhas"], 0)
+
+        pasta_tile = os.path.join(main.DIRETORIO_OUTPUT_BASE, *TILE)
+        self.assertEqual(sorted(nome for nome in os.listdir(pasta_tile) if nome.endswith(".SAFE")), [self.aprovado])
+        for relativo in ("MTD_MSIL2A.xml", "manifest.safe"):
+            self.assertTrue(os.path.isfile(os.path.join(pasta_tile, self.aprovado, relativo)))
+        self.assertIn(self.aprovado, inventario)
+        self.assertNotIn(self.rejeitado, inventario)
+
+
+if __name__ == "__main__":
+    unittest.main()